@@ -1,5 +1,5 @@
-from typing import Dict
-from datetime import datetime
+from typing import Dict, Optional
+from datetime import date, datetime
 
 from logging import getLogger
 
@@ -7,6 +7,9 @@ from models.security_identifier import SecurityIdentifier
 
 logger = getLogger(__name__)
 
+# lots held for more than a year are long term
+LONG_TERM_HOLDING_PERIOD = 365
+
 
 class ClosedLot:
     def __init__(
@@ -15,6 +18,7 @@ class ClosedLot:
         close_date_name: str,
         data: Dict[str, object],
         strptime_fmt: str = "%Y-%m-%d",
+        lot_id: Optional[str] = None,
     ):
         required_keywords = [
             "symbol",
@@ -34,14 +38,19 @@ class ClosedLot:
             return data[orig_key]
 
         def parse_date(key: str) -> datetime:
+            value = lookup(key)
+            # in-memory sources (e.g. DataFrames) may already carry parsed dates
+            if isinstance(value, date):
+                return datetime(value.year, value.month, value.day)
             try:
-                date = lookup(key)
-                return datetime.strptime(date, strptime_fmt)
+                return datetime.strptime(str(value), strptime_fmt)
             except ValueError:
-                logger.error(f"Failed to parse date {date} using {strptime_fmt}")
+                logger.error("Failed to parse date %s using %s", value, strptime_fmt)
                 raise
 
         self.data = data
+        # identifies the lot in its source (e.g. file and row) so audit records can refer back to it
+        self.lot_id = lot_id
 
         self.security_id = SecurityIdentifier(symbol=lookup("symbol"), cusip=lookup("cusip"))
         self.quantity: float = float(lookup("quantity"))
@@ -56,6 +65,10 @@ class ClosedLot:
         """Gets the holding period in days of the lot"""
         return self._holding_period.days
 
+    @property
+    def is_long_term(self) -> bool:
+        return self.holding_period > LONG_TERM_HOLDING_PERIOD
+
     def __str__(self):
         timefmt = "%Y-%m-%d"
         return (
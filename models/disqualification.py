@@ -0,0 +1,70 @@
+from dataclasses import dataclass
+from datetime import datetime
+from typing import List, NamedTuple, Optional, Tuple
+
+from models.closed_lot import ClosedLot
+from models.dividend import DividendType, Note
+from models.security_identifier import SecurityIdentifier
+
+
+class LotReference(NamedTuple):
+    '''A compact reference to a disqualifying lot, carrying only what's needed to describe it'''
+    lot_id: Optional[str]
+    quantity: float
+    open_date: datetime
+    holding_period: int
+
+    @classmethod
+    def from_lot(cls, lot: ClosedLot) -> "LotReference":
+        return cls(lot.lot_id, lot.quantity, lot.open_date, lot.holding_period)
+
+
+@dataclass
+class Disqualification:
+    '''Evidence for a (partially) disqualified dividend: which lots were held too briefly around the exdate,
+    and how the disqualified value was derived from them'''
+    security_id: SecurityIdentifier
+    payout_date: datetime
+    exdate: datetime
+    dividend_type: DividendType
+    value_per_share: float
+    qualified_percentage: float
+    disqualified_shares: float
+    disqualified_value: float
+    lots: List[LotReference]
+
+    @property
+    def holding_requirement(self) -> Tuple[int, int]:
+        '''Gets the (minimum holding period, relevant period) in days for the disqualified dividend type'''
+        return (61, 121) if self.dividend_type == DividendType.Qualified else (46, 91)
+
+    def render_lots(self, max_lots: Optional[int] = None) -> str:
+        '''Lists the disqualifying lots, one per line, truncated after max_lots (if not None)'''
+        shown = self.lots if max_lots is None else self.lots[:max_lots]
+        lines = [
+            f"Closed Lot {lot.lot_id}: {lot.quantity} of {self.security_id} "
+            f"Acquired {lot.open_date.strftime('%Y-%m-%d')} Held {lot.holding_period} days"
+            for lot in shown
+        ]
+        if len(shown) < len(self.lots):
+            lines.append(f"... and {len(self.lots) - len(shown)} more lots")
+        return "\n\t - " + "\n\t - ".join(lines)
+
+
+class DisqualificationNote(Note):
+    '''The note explaining a disqualification, on either the remaining qualified dividend or the synthesized one'''
+    def __init__(self, disqualification: Disqualification, synthesized: bool):
+        self.disqualification = disqualification
+        self.synthesized = synthesized
+
+    def render(self, max_lots: Optional[int] = None) -> str:
+        dq = self.disqualification
+        if self.synthesized:
+            return f"Synthesized nonqualified dividend due to:{dq.render_lots(max_lots)}"
+
+        min_holding_period, relevant_period = dq.holding_requirement
+        return (f"Disqualified ${dq.disqualified_value} from {dq.dividend_type.value}. The dividend on {dq.exdate.date()} had value"
+                f" ${dq.value_per_share} per share. {dq.qualified_percentage * 100:0.2f}% of the dividend"
+                f" value was classified as {dq.dividend_type.value}. {dq.disqualified_shares} shares were not held for"
+                f" {min_holding_period} days of the relevant {relevant_period} day period, which are as follows:"
+                f"{dq.render_lots(max_lots)}\n")
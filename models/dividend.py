@@ -1,9 +1,11 @@
+from abc import ABC, abstractmethod
 from enum import Enum
 from datetime import datetime
 from dateutil import parser
-from typing import Dict, Tuple, cast
+from typing import Dict, List, Optional, Set, Tuple, Union, cast
 from logging import getLogger
 from locale import atof
+from numbers import Real
 
 from models.security_identifier import SecurityIdentifier
 from utilities.user_selection import user_selector
@@ -38,6 +40,14 @@ class FieldName(Enum):
     Type = "Type"
 
 
+class Note(ABC):
+    '''A note whose text is only rendered when the dividend is output'''
+    @abstractmethod
+    def render(self, max_lots: Optional[int] = None) -> str:
+        '''Renders the note, listing at most max_lots lots (all of them if None)'''
+        raise NotImplementedError()
+
+
 class Dividend:
     def __init__(self,
         data: Dict[str, object],
@@ -46,12 +56,14 @@ class Dividend:
         value_key: str,
         type_key: str
     ):
-        self.date: datetime = parser.parse(str(data[date_key]))
+        raw_date = data[date_key]
+        self.date: datetime = raw_date if isinstance(raw_date, datetime) else parser.parse(str(raw_date))
         self.security_id = SecurityIdentifier(cusip=str(data[cusip_key]))
 
         self.value: float = 0
-        if type(data[value_key]) is float:
-            self.value = cast(float, data[value_key])
+        if isinstance(data[value_key], Real):
+            # includes numpy scalars from in-memory sources
+            self.value = float(cast(float, data[value_key]))
         elif type(data[value_key]) is str:
             self.value = atof(cast(str, data[value_key]))
         else:
@@ -62,6 +74,7 @@ class Dividend:
 
         # persist data, as it will be the source of truth
         self.data = data
+        self.notes: List[Union[str, Note]] = []
 
         self._value_key = value_key
         self._date_key = date_key
@@ -105,17 +118,37 @@ class Dividend:
 
         disqualified_div.security_id = self.security_id
         qualified_div.security_id = self.security_id
+        disqualified_div.notes = list(self.notes)
+        qualified_div.notes = list(self.notes)
         return qualified_div, disqualified_div
 
-    def add_note(self, note: str):
-        if "notes" in self.data and self.data["notes"] is str:
-            existing_note = self.data["notes"]
-            self.data["notes"] = f"{existing_note}; {note}"
-        else:
-            if "notes" in self.data:
-                logger.warn("Origianl notes field of non-string type will be renamed to 'original_notes' as a note is being added")
-                self.data["original_notes"] = self.data["notes"]
-            self.data["notes"] = note
+    def add_note(self, note: Union[str, Note]):
+        '''Adds a note to be rendered into the notes field when the dividend is output'''
+        self.notes.append(note)
+
+    def csv_keys(self) -> Set[str]:
+        '''Gets the keys of the row csv_row will produce, without rendering any notes'''
+        keys = set(self.data.keys())
+        if len(self.notes) > 0:
+            keys.add("notes")
+            if self.data.get("notes") is not None and not isinstance(self.data["notes"], str):
+                keys.add("original_notes")
+        return keys
+
+    def csv_row(self, max_note_lots: Optional[int] = None) -> Dict[str, object]:
+        '''Renders the notes into a copy of the data for output. Rendered notes aren't retained.
+        Call standardized_csv_data first if the row should use the standard field names'''
+        row = self.data.copy()
+        if len(self.notes) > 0:
+            rendered = "; ".join(note if isinstance(note, str) else note.render(max_note_lots) for note in self.notes)
+            existing_note = row.get("notes")
+            if isinstance(existing_note, str) and existing_note:
+                rendered = f"{existing_note}; {rendered}"
+            elif existing_note is not None and not isinstance(existing_note, str):
+                logger.warning("Original notes field of non-string type will be renamed to 'original_notes' as a note is being added")
+                row["original_notes"] = existing_note
+            row["notes"] = rendered
+        return row
 
     def add_exdate(self, exdate: datetime):
         self.data[FieldName.ExDate.value] = exdate.date()
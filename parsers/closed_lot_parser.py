@@ -1,9 +1,14 @@
-from typing import List
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+from datetime import datetime
+from itertools import chain, islice
 import csv
+import numpy as np
 
 from logging import getLogger
 
-from models.closed_lot import ClosedLot
+from models.closed_lot import LONG_TERM_HOLDING_PERIOD, ClosedLot
+from parsers.schema_profiles import detect_lot_profile
+from utilities.records import iter_records
 from utilities.user_selection import user_selector
 
 
@@ -17,23 +22,168 @@ Trading data from Wealthfront can be obtained from:
     Click on View cost basis details near the bottom of the page
     Select either Realized gain/loss and select Download CSV on the top right of the page
 
-TODO: Robinhood features.
-Robinhood provided a 'consolidated_transactions.csv' this year which, after some
-simple massaging and expanded tooling, should work with this tool as well.
-    For example, Long term sales are missing an open date since it isn't important.
+Robinhood provides a 'consolidated_transactions.csv', in which long term sales are
+missing an open date since it isn't important.
+
+Both layouts are registered in schema_profiles and read without prompting, as long as the dates of
+the first row are in the layout's format.
 """
 
 
-def read_closed_lots(filename: str) -> List[ClosedLot]:
+def select_date_columns(fieldnames: List[str]) -> Tuple[int, int]:
+    '''Asks the user (or the recorded selections) which columns hold the open and close dates of a lot'''
+    open_date_idx = user_selector.user_selection("Which of these should be the open date for the lot?", fieldnames)
+    close_date_idx = user_selector.user_selection("Which of these should be the close date for the lot?", fieldnames)
+    return open_date_idx, close_date_idx
+
+
+def iter_closed_lots(filename: str) -> Iterator[ClosedLot]:
+    '''Lazily reads the closed lots of a file, one row at a time. Files in a known broker layout are read
+    without prompting'''
     with open(filename, newline="") as f:
         reader = csv.DictReader(f)
         assert reader.fieldnames is not None, f"Failed to read field names from {filename}"
         fieldnames = list(reader.fieldnames)
-        open_date_idx = user_selector.user_selection("Which of these should be the open date for the lot?", fieldnames)
-        close_date_idx = user_selector.user_selection("Which of these should be the close date for the lot?", fieldnames)
-
-        transactions = [
-            ClosedLot(fieldnames[open_date_idx], fieldnames[close_date_idx], row)
-            for row in reader
-        ]
-    return transactions
+        first_row = next(reader, None)
+
+        profile = detect_lot_profile(fieldnames, None if first_row is None else
+                                     [first_row.get(name) or "" for name in fieldnames])
+        if profile is None:
+            open_date_idx, close_date_idx = select_date_columns(fieldnames)
+            strptime_fmt = "%Y-%m-%d"
+        else:
+            logger.info("Reading %s as a %s export", filename, profile.name)
+            indices = profile.column_indices(fieldnames)
+            open_date_idx, close_date_idx = indices[profile.open_date], indices[profile.close_date]
+            strptime_fmt = profile.date_format
+        open_date_key, close_date_key = fieldnames[open_date_idx], fieldnames[close_date_idx]
+
+        rows = reader if first_row is None else chain([first_row], reader)
+        for row_number, row in enumerate(rows, start=1):
+            if profile is not None:
+                profile.normalize_row(row, open_date_key, close_date_key)
+            yield ClosedLot(open_date_key, close_date_key, row, strptime_fmt, lot_id=f"{filename}:{row_number}")
+
+
+def read_closed_lots(filename: str) -> List[ClosedLot]:
+    return list(iter_closed_lots(filename))
+
+
+def iter_closed_lot_records(
+    records: Iterable,
+    open_date_name: str = "Open Date",
+    close_date_name: str = "Close Date",
+    strptime_fmt: str = "%Y-%m-%d",
+) -> Iterator[ClosedLot]:
+    '''Lazily builds closed lots from in-memory data: ClosedLot instances are passed through, while the rows of a
+    DataFrame, record array or iterable of mappings are copied and read using the provided date column names'''
+    for idx, row in enumerate(iter_records(records)):
+        if isinstance(row, ClosedLot):
+            yield row
+        else:
+            yield ClosedLot(open_date_name, close_date_name, dict(row), strptime_fmt, lot_id=str(idx))
+
+
+def read_closed_lot_records(
+    records: Iterable,
+    open_date_name: str = "Open Date",
+    close_date_name: str = "Close Date",
+    strptime_fmt: str = "%Y-%m-%d",
+) -> List[ClosedLot]:
+    return list(iter_closed_lot_records(records, open_date_name, close_date_name, strptime_fmt))
+
+
+def parse_amounts(values: np.ndarray) -> np.ndarray:
+    '''Vectorized conversion of dollar amount strings such as "$1,234.56" or "(12.00)" to floats'''
+    values = np.char.strip(values)
+    negative = np.char.startswith(values, "(")
+    for token in ("$", ",", "(", ")"):
+        values = np.char.replace(values, token, "")
+    values = np.where(values == "", "0", values)
+    amounts = values.astype(float)
+    return np.where(negative, -amounts, amounts)
+
+
+def parse_date(value: str, date_format: str) -> np.datetime64:
+    try:
+        return np.datetime64(datetime.strptime(value, date_format).date())
+    except ValueError:
+        return np.datetime64("NaT")
+
+
+def parse_dates(values: np.ndarray, date_format: str, missing: Optional[np.ndarray] = None) -> np.ndarray:
+    '''Converts date strings to datetime64[D], vectorized for ISO dates. Blank dates are taken from missing, and
+    any which are still blank or can't be parsed are NaT'''
+    values = np.char.strip(values)
+    blank = values == ""
+    dates: Optional[np.ndarray] = None
+    if date_format == "%Y-%m-%d":
+        try:
+            dates = np.where(blank, "NaT", values).astype("datetime64[D]")
+        except ValueError:
+            # some of the dates can't be parsed, which only the parsing one date at a time below can single out
+            pass
+    if dates is None:
+        dates = np.array([parse_date(value, date_format) for value in values.tolist()], dtype="datetime64[D]")
+    if missing is not None:
+        dates = np.where(blank, missing, dates)
+    return dates
+
+
+def read_closed_lot_columns(filename: str, chunk_size: int = 100_000) -> Iterator[Dict[str, np.ndarray]]:
+    '''Streams the closed lots of a file as chunks of columnar arrays, without building ClosedLot instances.
+
+    Each chunk holds at most chunk_size lots, keyed as open_date and close_date (datetime64[D]), and proceeds
+    and cost_basis (float). Files in a known broker layout are read without prompting. A missing open date is only
+    filled in where the layout allows it; otherwise, as for ClosedLot, a missing or unparseable date raises a
+    ValueError naming the lot.
+    '''
+    with open(filename, newline="") as f:
+        reader = csv.reader(f)
+        fieldnames = next(reader, None)
+        assert fieldnames is not None, f"Failed to read field names from {filename}"
+        first_row = next(reader, None)
+
+        profile = detect_lot_profile(fieldnames, None if first_row is None else
+                                     (first_row + [""] * len(fieldnames))[:len(fieldnames)])
+        if profile is None:
+            open_date_idx, close_date_idx = select_date_columns(fieldnames)
+            proceeds_idx = user_selector.user_selection("Which of these is the proceeds for the lot?", fieldnames)
+            cost_basis_idx = user_selector.user_selection("Which of these is the cost basis for the lot?", fieldnames)
+            date_format = "%Y-%m-%d"
+        else:
+            logger.info("Reading %s as a %s export", filename, profile.name)
+            indices = profile.column_indices(fieldnames)
+            open_date_idx, close_date_idx = indices[profile.open_date], indices[profile.close_date]
+            proceeds_idx, cost_basis_idx = indices[profile.proceeds], indices[profile.cost_basis]
+            date_format = profile.date_format
+        columns = [open_date_idx, close_date_idx, proceeds_idx, cost_basis_idx]
+
+        rows_iter = reader if first_row is None else chain([first_row], reader)
+        rows_read = 0
+        while True:
+            rows = list(islice(rows_iter, chunk_size))
+            if len(rows) == 0:
+                break
+            table = np.array([[row[i] for i in columns] for row in rows if len(row) > 0], dtype=str)
+            if len(table) == 0:
+                continue
+            close_date = parse_dates(table[:, 1], date_format)
+            missing_open_date = close_date - (LONG_TERM_HOLDING_PERIOD + 1) \
+                if profile is not None and profile.missing_open_date_is_long_term else None
+            open_date = parse_dates(table[:, 0], date_format, missing=missing_open_date)
+
+            # rows are numbered like the lot IDs of iter_closed_lots
+            invalid = np.flatnonzero(np.isnat(open_date) | np.isnat(close_date))
+            if len(invalid) > 0:
+                idx = int(invalid[0])
+                raise ValueError(f"Failed to parse the dates of lot {filename}:{rows_read + idx + 1} using {date_format}:"
+                                 f" open date '{table[idx, 0]}', close date '{table[idx, 1]}'")
+            rows_read += len(table)
+
+            yield {
+                "open_date": open_date,
+                "close_date": close_date,
+                "proceeds": parse_amounts(table[:, 2]),
+                "cost_basis": parse_amounts(table[:, 3]),
+            }
@@ -1,9 +1,14 @@
 import csv
-from typing import List, Set
+from itertools import chain
+from typing import Iterable, Iterator, List, Optional, Set
 from datetime import datetime
 from logging import getLogger
 
+from models.disqualification import Disqualification
 from models.dividend import Dividend, FieldName
+from parsers.schema_profiles import detect_dividend_profile
+from utilities.external_sort import read_run, write_run
+from utilities.records import iter_records
 from utilities.user_selection import user_selector
 
 logger = getLogger(__name__)
@@ -24,40 +29,113 @@ def get_fieldname_index(fieldnames: List[str], fieldname: FieldName, user_friend
         return user_selector.user_selection(f"Which of these is the {user_friendly_desc}?", fieldnames)
 
 
-def read_dividends(filename: str) -> List[Dividend]:
+def iter_dividends(filename: str) -> Iterator[Dividend]:
+    '''Lazily reads the dividends of a file, one row at a time. Files in a known layout are read without prompting'''
     with open(filename, newline="") as f:
         reader = csv.DictReader(f)
         assert reader.fieldnames is not None, f"Failed to read field names from {filename}"
         fieldnames = list(reader.fieldnames)
+        first_row = next(reader, None)
+
+        profile = detect_dividend_profile(fieldnames, None if first_row is None else
+                                          [first_row.get(name) or "" for name in fieldnames])
+        if profile is None:
+            date_idx = get_fieldname_index(fieldnames, FieldName.PayoutDate, "date")
+            cusip_idx = get_fieldname_index(fieldnames, FieldName.CUSIP, "cusip")
+            value_idx = get_fieldname_index(fieldnames, FieldName.Amount, "dollar value")
+            type_idx = get_fieldname_index(fieldnames, FieldName.Type, "dividend type")
+        else:
+            logger.info("Reading %s as %s output", filename, profile.name)
+            indices = profile.column_indices(fieldnames)
+            date_idx, cusip_idx, value_idx, type_idx = [indices[column] for column in profile.required_columns]
+        date_key, cusip_key, value_key, type_key = (fieldnames[date_idx], fieldnames[cusip_idx], fieldnames[value_idx],
+                                                    fieldnames[type_idx])
+
+        rows = reader if first_row is None else chain([first_row], reader)
+        for row in rows:
+            if profile is not None:
+                profile.normalize_row(row, date_key, value_key, type_key)
+            yield Dividend(row, date_key, cusip_key, value_key, type_key)
+
+
+def read_dividends(filename: str) -> List[Dividend]:
+    return list(iter_dividends(filename))
+
 
-        date_idx = get_fieldname_index(fieldnames, FieldName.PayoutDate, "date")
-        cusip_idx = get_fieldname_index(fieldnames, FieldName.CUSIP, "cusip")
-        value_idx = get_fieldname_index(fieldnames, FieldName.Amount, "dollar value")
-        type_idx = get_fieldname_index(fieldnames, FieldName.Type, "dividend type")
+def iter_dividend_records(records: Iterable) -> Iterator[Dividend]:
+    '''Lazily builds dividends from in-memory data: Dividend instances are passed through, while the rows of a
+    DataFrame, record array or iterable of mappings are copied and must use the standard field names'''
+    for row in iter_records(records):
+        if isinstance(row, Dividend):
+            yield row
+        else:
+            yield Dividend(dict(row), FieldName.PayoutDate.value, FieldName.CUSIP.value, FieldName.Amount.value,
+                           FieldName.Type.value)
 
-        transactions = [
-            Dividend(row, fieldnames[date_idx], fieldnames[cusip_idx], fieldnames[value_idx], fieldnames[type_idx])
-            for row in reader
-        ]
-    return transactions
 
+def read_dividend_records(records: Iterable) -> List[Dividend]:
+    return list(iter_dividend_records(records))
 
-def write_dividends(dividends: List[Dividend]):
+
+def write_dividends(dividends: Iterable[Dividend], max_note_lots: Optional[int] = None):
+    '''Writes the dividends to a timestamped csv. Dividends which aren't already in a list are streamed through a
+    temporary file, as every row must be seen to determine the columns before the first row is written.
+    Notes are rendered one row at a time as they're written, listing at most max_note_lots lots each.'''
     filename = f"adjusted_dividends_{datetime.now().strftime('%Y-%m-%d_%H-%M')}.csv"
 
-    list(map(Dividend.standardized_csv_data, dividends))
-
-    if len(dividends) > 0:
-        keys: Set[str] = set()
-        for div in dividends:
-            keys.update(div.data.keys())
-
-        # ensure the csv columns are sensibly orderede
-        fieldnames = [FieldName.PayoutDate.value, FieldName.CUSIP.value, FieldName.Amount.value, FieldName.Type.value,
-                      FieldName.ExDate.value]
-        fieldnames += [nonstandard_key for nonstandard_key in keys if nonstandard_key not in fieldnames]
-        with open(filename, "w") as f:
-            writer = csv.DictWriter(f, fieldnames)
-            writer.writeheader()
-            writer.writerows([d.data for d in dividends])
-        logger.info(f"Wrote adjusted dividends to {filename}")
+    keys: Set[str] = set()
+
+    def standardize(div: Dividend) -> Dividend:
+        div.standardized_csv_data()
+        keys.update(div.csv_keys())
+        return div
+
+    if isinstance(dividends, list):
+        standardized: Iterable[Dividend] = list(map(standardize, dividends))
+        run = None
+    else:
+        run = write_run(map(standardize, dividends))
+        standardized = read_run(run)
+
+    try:
+        if len(keys) > 0:
+            # ensure the csv columns are sensibly orderede
+            fieldnames = [FieldName.PayoutDate.value, FieldName.CUSIP.value, FieldName.Amount.value, FieldName.Type.value,
+                          FieldName.ExDate.value]
+            fieldnames += [nonstandard_key for nonstandard_key in keys if nonstandard_key not in fieldnames]
+            with open(filename, "w") as f:
+                writer = csv.DictWriter(f, fieldnames)
+                writer.writeheader()
+                for div in standardized:
+                    writer.writerow(div.csv_row(max_note_lots))
+            logger.info("Wrote adjusted dividends to %s", filename)
+    finally:
+        if run is not None:
+            run.close()
+
+
+def write_disqualifications(disqualifications: Iterable[Disqualification], filename: str):
+    '''Writes an audit csv of the disqualifications, with a row per disqualifying lot'''
+    fieldnames = [FieldName.PayoutDate.value, "Symbol", FieldName.CUSIP.value, FieldName.ExDate.value, FieldName.Type.value,
+                  "Value Per Share", "Qualified Percentage", "Disqualified Value", "Lot ID", "Quantity", "Acquired",
+                  "Held Days"]
+    with open(filename, "w") as f:
+        writer = csv.DictWriter(f, fieldnames)
+        writer.writeheader()
+        for dq in disqualifications:
+            for lot in dq.lots:
+                writer.writerow({
+                    FieldName.PayoutDate.value: dq.payout_date.date(),
+                    "Symbol": dq.security_id.symbol,
+                    FieldName.CUSIP.value: dq.security_id.cusip,
+                    FieldName.ExDate.value: dq.exdate.date(),
+                    FieldName.Type.value: dq.dividend_type.value,
+                    "Value Per Share": dq.value_per_share,
+                    "Qualified Percentage": round(dq.qualified_percentage * 100, 2),
+                    "Disqualified Value": dq.disqualified_value,
+                    "Lot ID": lot.lot_id,
+                    "Quantity": lot.quantity,
+                    "Acquired": lot.open_date.date(),
+                    "Held Days": lot.holding_period,
+                })
+    logger.info("Wrote disqualification audit to %s", filename)
@@ -0,0 +1,192 @@
+from dataclasses import dataclass, field
+from datetime import datetime, timedelta
+from logging import getLogger
+from typing import Dict, List, Optional, Sequence, Tuple
+
+from models.closed_lot import LONG_TERM_HOLDING_PERIOD
+from models.dividend import DividendType, FieldName
+
+logger = getLogger(__name__)
+
+"""
+Known broker export layouts, detected from a csv's header row so that files in these layouts are read
+without any interactive prompts. A profile is only chosen if the dates of the first data row also parse with its
+date format, so files whose headers or dates don't match a profile fall back to prompting.
+Column names are matched case-insensitively, ignoring surrounding whitespace.
+"""
+
+
+def _normalize_header(name: str) -> str:
+    return name.strip().lower()
+
+
+def _column_indices(columns: Sequence[str], fieldnames: Sequence[str]) -> Dict[str, int]:
+    normalized = [_normalize_header(name) for name in fieldnames]
+    return {column: normalized.index(_normalize_header(column)) for column in columns}
+
+
+def _parses(value: str, date_format: str) -> bool:
+    try:
+        datetime.strptime(value.strip(), date_format)
+        return True
+    except ValueError:
+        return False
+
+
+@dataclass(frozen=True)
+class LotSchemaProfile:
+    name: str
+    open_date: str
+    close_date: str
+    proceeds: str
+    cost_basis: str
+    date_format: str = "%Y-%m-%d"
+    # lots missing an open date are long term sales, which some brokers don't report an open date for
+    missing_open_date_is_long_term: bool = False
+    # any other columns the header must have for the profile to match
+    other_columns: Tuple[str, ...] = ("symbol", "cusip", "quantity")
+
+    @property
+    def required_columns(self) -> Tuple[str, ...]:
+        return (self.open_date, self.close_date, self.proceeds, self.cost_basis) + self.other_columns
+
+    def column_indices(self, fieldnames: Sequence[str]) -> Dict[str, int]:
+        '''Maps each required column of the profile to its index in the header'''
+        return _column_indices(self.required_columns, fieldnames)
+
+    def accepts(self, fieldnames: Sequence[str], row: Sequence[str]) -> bool:
+        '''Whether the dates of a data row, aligned with the header, are in the profile's date format'''
+        indices = self.column_indices(fieldnames)
+        open_date, close_date = row[indices[self.open_date]], row[indices[self.close_date]]
+        if self.missing_open_date_is_long_term and not open_date.strip():
+            return _parses(close_date, self.date_format)
+        return _parses(open_date, self.date_format) and _parses(close_date, self.date_format)
+
+    def normalize_row(self, row: Dict[str, str], open_date_key: str, close_date_key: str) -> Dict[str, str]:
+        '''Fills in what the broker leaves out, in place'''
+        if self.missing_open_date_is_long_term and not row[open_date_key].strip():
+            close_date = datetime.strptime(row[close_date_key].strip(), self.date_format)
+            row[open_date_key] = (close_date - timedelta(days=LONG_TERM_HOLDING_PERIOD + 1)).strftime(self.date_format)
+        return row
+
+
+@dataclass(frozen=True)
+class DividendSchemaProfile:
+    name: str
+    payout_date: str = FieldName.PayoutDate.value
+    cusip: str = FieldName.CUSIP.value
+    amount: str = FieldName.Amount.value
+    type: str = FieldName.Type.value
+    # None parses dates with dateutil, which accepts most formats but is much slower
+    date_format: Optional[str] = None
+    # maps the broker's dividend type descriptions (lowercased) to the standard types
+    type_names: Dict[str, DividendType] = field(default_factory=dict)
+
+    @property
+    def required_columns(self) -> Tuple[str, ...]:
+        return (self.payout_date, self.cusip, self.amount, self.type)
+
+    def column_indices(self, fieldnames: Sequence[str]) -> Dict[str, int]:
+        '''Maps each required column of the profile to its index in the header'''
+        return _column_indices(self.required_columns, fieldnames)
+
+    def accepts(self, fieldnames: Sequence[str], row: Sequence[str]) -> bool:
+        '''Whether the date of a data row, aligned with the header, is in the profile's date format'''
+        return self.date_format is None or _parses(row[self.column_indices(fieldnames)[self.payout_date]],
+                                                   self.date_format)
+
+    def normalize_row(self, row: Dict[str, object], date_key: str, value_key: str, type_key: str) -> Dict[str, object]:
+        '''Parses the date, strips currency formatting from the amount and standardizes the type, in place'''
+        if self.date_format is not None:
+            row[date_key] = datetime.strptime(str(row[date_key]).strip(), self.date_format)
+        row[value_key] = str(row[value_key]).replace("$", "").replace(",", "").strip()
+        dividend_type = self.type_names.get(str(row[type_key]).strip().lower())
+        if dividend_type is not None:
+            row[type_key] = dividend_type.value
+        return row
+
+
+STANDARD_DIVIDEND_TYPE_NAMES = {dtype.value.lower(): dtype for dtype in DividendType}
+
+# The Wealthfront and Robinhood column names follow the exports described in closed_lot_parser, but no sample of
+# either is checked in, so they are unverified. If a header or date format doesn't actually match, the first row
+# check in detect_lot_profile rejects the profile and the columns are prompted for instead.
+LOT_SCHEMA_PROFILES: List[LotSchemaProfile] = [
+    # Wealthfront: Realized gain/loss "Download CSV" (see closed_lot_parser)
+    LotSchemaProfile(
+        name="Wealthfront",
+        open_date="Date Acquired",
+        close_date="Date Sold",
+        proceeds="Proceeds",
+        cost_basis="Cost Basis",
+    ),
+    # Robinhood: consolidated_transactions.csv, which omits the open date of long term sales
+    LotSchemaProfile(
+        name="Robinhood",
+        open_date="Date Acquired",
+        close_date="Date Sold",
+        proceeds="Proceeds",
+        cost_basis="Cost Basis",
+        date_format="%m/%d/%Y",
+        missing_open_date_is_long_term=True,
+        other_columns=("symbol", "cusip", "quantity", "description"),
+    ),
+]
+
+DIVIDEND_SCHEMA_PROFILES: List[DividendSchemaProfile] = [
+    # parse-1099 (https://pypi.org/project/parse-1099/) dividends output, as written by parse_1099.Dividends in
+    # version 2.1.2: security,cusip,transaction_date,amount,transaction_type[,notes], with dates such as 03/15/23
+    # and amounts with thousands separators. Files using the standard field names are read by dividend_parser
+    # without a profile.
+    DividendSchemaProfile(
+        name="parse-1099",
+        payout_date="transaction_date",
+        cusip="cusip",
+        amount="amount",
+        type="transaction_type",
+        date_format="%m/%d/%y",
+        type_names={
+            **STANDARD_DIVIDEND_TYPE_NAMES,
+            "nonqualified dividend": DividendType.NonQualified,
+            "qualified dividend": DividendType.Qualified,
+            "section 199a dividend": DividendType.Section_199A,
+            "tax-exempt dividend": DividendType.Tax_Exempt,
+            "foreign tax withheld": DividendType.Tax_Withheld,
+        },
+    ),
+]
+
+
+def _matches(required_columns: Sequence[str], fieldnames: Sequence[str]) -> bool:
+    header = {_normalize_header(name) for name in fieldnames}
+    return all(_normalize_header(column) in header for column in required_columns)
+
+
+def _detect(profiles, fieldnames: Sequence[str], first_row: Optional[Sequence[str]]):
+    matches = sorted((p for p in profiles if _matches(p.required_columns, fieldnames)),
+                     key=lambda p: len(p.required_columns), reverse=True)
+    for profile in matches:
+        if first_row is None or profile.accepts(fieldnames, first_row):
+            return profile
+        logger.info("The header matches the %s layout, but its dates don't", profile.name)
+    return None
+
+
+def detect_lot_profile(fieldnames: Sequence[str], first_row: Optional[Sequence[str]] = None) \
+        -> Optional[LotSchemaProfile]:
+    '''Finds the most specific registered lot profile matching the header and the first data row, if any'''
+    return _detect(LOT_SCHEMA_PROFILES, fieldnames, first_row)
+
+
+def detect_dividend_profile(fieldnames: Sequence[str], first_row: Optional[Sequence[str]] = None) \
+        -> Optional[DividendSchemaProfile]:
+    '''Finds the most specific registered dividend profile matching the header and the first data row, if any'''
+    return _detect(DIVIDEND_SCHEMA_PROFILES, fieldnames, first_row)
+
+
+def register_lot_profile(profile: LotSchemaProfile):
+    LOT_SCHEMA_PROFILES.append(profile)
+
+
+def register_dividend_profile(profile: DividendSchemaProfile):
+    DIVIDEND_SCHEMA_PROFILES.append(profile)
@@ -1,171 +1,652 @@
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass
 from datetime import datetime
-from functools import reduce
-from itertools import chain
+from itertools import chain, groupby
 from pandas.core.series import Series
-from typing import List, Union, Tuple, Iterable
+from typing import Callable, Deque, Dict, Iterable, Iterator, List, Mapping, Optional, Set, Tuple, TypeVar, Union, cast
+import numpy as np
 
-from logging import getLogger
+from logging import getLogger, DEBUG
 from argparse import Namespace
 
 from models.closed_lot import ClosedLot
+from models.disqualification import Disqualification, DisqualificationNote, LotReference
 from models.dividend import Dividend, DividendType
 from models.security_identifier import SecurityIdentifier
-from parsers.closed_lot_parser import read_closed_lots
-from parsers.dividend_parser import read_dividends, write_dividends
+from parsers.closed_lot_parser import iter_closed_lot_records, iter_closed_lots
+from parsers.dividend_parser import (
+    iter_dividend_records, iter_dividends, write_dividends, write_disqualifications
+)
+from repositories.prefetching_repository import PrefetchingRepository
+from repositories.security_repository import SecurityNotFound, SecurityRepository
+from repositories.symbol_repository import SymbolRepository
+from repositories.tiered_repository import TieredRepository
 from repositories.yahoo_repository import YahooRepository
+from utilities.exdate_windows import DateWindow, ExdatePlanner, covers, exdate_window, tax_year_window
+from utilities.external_sort import append_to_run, external_sort, open_run, read_run, write_run
 
 logger = getLogger(__name__)
 
+T = TypeVar("T")
+
+
+@dataclass
+class AnalysisResult:
+    '''The outcome of a qualified dividends analysis.
+
+    dividends -- every input dividend, with disqualified ones split into their qualified and nonqualified parts
+    disqualifications -- the evidence behind each split, in the order the splits were made
+    '''
+    dividends: List[Dividend]
+    disqualifications: List[Disqualification]
+
+    @property
+    def adjustment_occurred(self) -> bool:
+        return len(self.disqualifications) > 0
+
 
 def is_qualified(div: Dividend) -> bool:
     return div.type == DividendType.Qualified or div.type == DividendType.Section_199A
 
 
 def get_dividend_exdate(dividend: Dividend, dividend_exdates: Series) -> Union[datetime, None]:
-    '''Get the latest exdate still preceding the dividend payment date from the provided list of exdates'''
-    parsed_exdates = map(lambda x: datetime(x.year, x.month, x.day), dividend_exdates.keys())
-    applicable_exdates = [exdate for exdate in parsed_exdates if exdate < dividend.date]
+    '''Get the latest exdate still preceding the dividend payment date from the provided list of exdates.
+    Exdates further back than MAX_EXDATE_LAG are taken to belong to earlier dividends.'''
+    parsed_exdates = [datetime(x.year, x.month, x.day) for x in dividend_exdates.keys()]
+    window = exdate_window(dividend.date)
+    applicable_exdates = [exdate for exdate in parsed_exdates if window.start <= exdate < window.end]
 
     if len(applicable_exdates) == 0:
         printable_exdates = ','.join(map(lambda d: d.strftime('%Y-%m-%d'), parsed_exdates))
-        logger.error(f"For dividend {dividend} got no valid exdates (out of: {printable_exdates})")
+        logger.error("For dividend %s got no valid exdates (out of: %s)", dividend, printable_exdates)
         return None
 
     return max(applicable_exdates)
 
 
+def hydrate_or_note(security_id: SecurityIdentifier, repository: SymbolRepository, unresolved_cusips: Set[str]):
+    '''Hydrates the security identifier, noting its CUSIP rather than failing if the repository can't find it'''
+    try:
+        security_id.hydrate(repository)
+    except SecurityNotFound:
+        unresolved_cusips.add(cast(str, security_id.cusip))
+
+
+def log_unresolved(unresolved_cusips: Set[str]):
+    if len(unresolved_cusips) > 0:
+        logger.warning("Couldn't find symbols for CUSIPs %s. Their dividends are passed through unchanged",
+                       ','.join(sorted(unresolved_cusips)))
+
+
+def log_outside_tax_year(count: int, tax_year: int):
+    if count > 0:
+        logger.warning("%d qualified dividends weren't paid in %d. They're passed through unchanged", count, tax_year)
+
+
+def find_disqualified_lots(div: Dividend, exdate: datetime, lots: Iterable[ClosedLot]) -> List[ClosedLot]:
+    '''Finds the lots of the dividend's security which weren't held long enough around the exdate for the
+    dividend to keep its classification.
+
+    :param lots: Should be lots of the same security as the dividend.
+
+    Caveat: Assume that securities analyzed are common stock
+    Qualified Dividends
+    > If the payment is from a common stock you are required to have held it for more than 60 days
+    > during the 121-day period that begins 60 days before the ex-dividend date of the dividend
+    Section 199A Dividends
+    > The QBID may not be taken for any dividend reported in box 5 for dividends received on a share
+    > of REIT or RIC stock that is held for 45 days or less during the 91-day period beginning on the
+    > date that is 45 days before the date on which such share became ex-dividend with respect to the dividend
+
+    To get a dividend, you must hold the stock on the exdate. Therefore, the question of whether a stock
+    was held for 61 (or 46) of the 121 days can be rephrased as whether the exdate fell within any holding periods
+    shorter than 61 (or 46) days. Any holding periods longer than 60 (45) days containing the exdate are naturally ok,
+    and any short holding periods not containing the exdate wouldn't have resulted in any dividends in the
+    first place.
+
+    The holder of the stock at closing the day before the exdate / at opening the day of the exdate is the
+    recipient of the dividend. Therefore, the open date comparison is non-inclusive (buying the stock on the
+    exdate doesn't give you the dividend) but the close date comparison is inclusive (selling the stock on the
+    exdate still gives you the dividend).
+    '''
+    return [
+        lot for lot in lots
+        if lot.open_date < exdate and exdate <= lot.close_date
+        and ((div.type == DividendType.Qualified and lot.holding_period < 61)
+             or (div.type == DividendType.Section_199A and lot.holding_period < 46))
+    ]
+
+
+def split_disqualified_dividend(
+        div: Dividend,
+        exdate: datetime,
+        dividend_value_per_share: float,
+        related_dividends: List[Dividend],
+        disqualified_lots: List[ClosedLot]) -> Tuple[Dividend, Dividend, Disqualification]:
+    '''Splits the disqualified value out of a dividend, returning the remaining qualified dividend, the synthesized
+    nonqualified dividend and the record of the disqualification.
+
+    :param related_dividends: All dividends of the security paid on the same date as div (including div).
+    '''
+    # sometimes a fraction of the dividend is qualified. Calculate the total for the security
+    # on the dividend date to then quanitfy what fraction of the dividend was qualified
+    # purposefully avoid the foreign tax withheld values
+    total_dividend_amount = sum(d.value for d in related_dividends if d.value > 0)
+    qualified_percentage = div.value / total_dividend_amount
+
+    # create a new dividend from the disqualified value of the old one
+    disqualified_shares = sum(lot.quantity for lot in disqualified_lots)
+    disqualified_value = round(disqualified_shares * dividend_value_per_share * qualified_percentage, 2)
+    qdiv, dqdiv = div.disqualify(disqualified_value)
+
+    disqualification = Disqualification(
+        security_id=div.security_id,
+        payout_date=div.date,
+        exdate=exdate,
+        dividend_type=div.type,
+        value_per_share=dividend_value_per_share,
+        qualified_percentage=qualified_percentage,
+        disqualified_shares=disqualified_shares,
+        disqualified_value=disqualified_value,
+        lots=[LotReference.from_lot(lot) for lot in disqualified_lots],
+    )
+
+    # the notes share the record, and are only rendered once the dividends are output
+    qdiv.add_note(DisqualificationNote(disqualification, synthesized=False))
+    dqdiv.add_note(DisqualificationNote(disqualification, synthesized=True))
+
+    if logger.isEnabledFor(DEBUG):
+        logger.debug("Disqualified $%s of %s due to %s", disqualified_value, div,
+                     ", ".join(map(str, disqualified_lots)))
+
+    return qdiv, dqdiv, disqualification
+
+
+# (dividend, its exdate, the short lots of its security) for a dividend whose lots need to be checked
+Evaluation = Tuple[Dividend, datetime, List[ClosedLot]]
+
+
+def evaluate_shard(
+        lot_open: np.ndarray,
+        lot_close: np.ndarray,
+        lot_holding: np.ndarray,
+        exdates: np.ndarray,
+        min_holding_periods: np.ndarray) -> List[np.ndarray]:
+    '''The same test as find_disqualified_lots, over compact date ordinal columns for a single security.
+    Returns, for each exdate, the indices of the lots which disqualify it'''
+    return [
+        np.flatnonzero((lot_open < exdate) & (exdate <= lot_close) & (lot_holding < min_holding_period))
+        for exdate, min_holding_period in zip(exdates.tolist(), min_holding_periods.tolist())
+    ]
+
+
+# the total cost (lots x dividends) of the lot search below which it isn't worth starting a process pool. That's
+# roughly a third of a second of vectorized search on a single core
+MIN_PARALLEL_COST = 100_000_000
+
+
+def find_all_disqualified_lots(evaluations: List[Evaluation], jobs: int = 1) -> List[List[ClosedLot]]:
+    '''Runs find_disqualified_lots for every evaluation, vectorized with NumPy and, if the search is costly enough
+    to be worth it, across a pool of jobs processes.
+
+    Evaluations are sharded by security, and each shard is converted to NumPy columns of date ordinals, which are
+    also what's shipped to the workers rather than pickled lots and dividends. Shards whose cost (lots x dividends)
+    dominates the portfolio are split by exdate into pieces that only carry the lots open across their exdates.
+    Pieces are queued largest first and idle workers pull the next one, so a single large ETF doesn't leave the other
+    workers waiting. Results come back in the order of the evaluations regardless of which worker finished first.
+    '''
+    shards: Dict[int, List[int]] = {}
+    for idx, (_, _, lots) in enumerate(evaluations):
+        shards.setdefault(id(lots), []).append(idx)
+
+    # the date columns of every shard's lots are built in a single pass, then sliced per shard
+    shard_lots = [evaluations[idxs[0]][2] for idxs in shards.values()]
+    all_lots = list(chain.from_iterable(shard_lots))
+    all_open = np.fromiter((lot.open_date.toordinal() for lot in all_lots), dtype=np.int32, count=len(all_lots))
+    all_close = np.fromiter((lot.close_date.toordinal() for lot in all_lots), dtype=np.int32, count=len(all_lots))
+    all_holding = all_close - all_open
+    offsets = np.cumsum([0] + [len(lots) for lots in shard_lots]).tolist()
+
+    # (cost, lots of the piece, evaluation indices, arguments for evaluate_shard)
+    pieces: List[Tuple[int, List[ClosedLot], List[int], Tuple[np.ndarray, ...]]] = []
+    total_cost = sum(len(lots) * len(idxs) for lots, idxs in zip(shard_lots, shards.values()))
+    parallel = jobs > 1 and total_cost >= MIN_PARALLEL_COST
+    target_cost = max(1, total_cost // (jobs * 4) if parallel else total_cost)
+    for shard, (lots, idxs) in enumerate(zip(shard_lots, shards.values())):
+        shard_range = slice(offsets[shard], offsets[shard + 1])
+        lot_open, lot_close, lot_holding = all_open[shard_range], all_close[shard_range], all_holding[shard_range]
+
+        idxs = sorted(idxs, key=lambda i: evaluations[i][1])
+        exdates = np.array([evaluations[i][1].toordinal() for i in idxs], dtype=np.int32)
+        min_holding_periods = np.array(
+            [61 if evaluations[i][0].type == DividendType.Qualified else 46 for i in idxs], dtype=np.int32)
+
+        piece_size = max(1, target_cost // max(1, len(lots)))
+        for start in range(0, len(idxs), piece_size):
+            piece = slice(start, start + piece_size)
+            in_piece = (lot_close >= exdates[piece].min()) & (lot_open < exdates[piece].max())
+            lot_indices = np.flatnonzero(in_piece)
+            pieces.append((
+                len(lot_indices) * len(idxs[piece]),
+                [lots[i] for i in lot_indices.tolist()],
+                idxs[piece],
+                (lot_open[in_piece], lot_close[in_piece], lot_holding[in_piece], exdates[piece], min_holding_periods[piece]),
+            ))
+
+    disqualified_lots: List[List[ClosedLot]] = [[] for _ in evaluations]
+    if parallel:
+        pieces.sort(key=lambda piece: piece[0], reverse=True)
+        with ProcessPoolExecutor(max_workers=jobs) as executor:
+            futures = [executor.submit(evaluate_shard, *piece[3]) for piece in pieces]
+            results = [future.result() for future in futures]
+    else:
+        results = [evaluate_shard(*piece[3]) for piece in pieces]
+    for (_, piece_lots, piece_idxs, _), piece_results in zip(pieces, results):
+        for eval_idx, lot_indices in zip(piece_idxs, piece_results):
+            disqualified_lots[eval_idx] = [piece_lots[i] for i in lot_indices.tolist()]
+    return disqualified_lots
+
+
 def identify_and_separate_disqualified_dividends(
         dividends: List[Dividend],
         all_lots: List[ClosedLot],
         securities_with_qual_divs: Iterable[SecurityIdentifier],
-        dividend_exdates: Series) -> Tuple[List[Dividend], bool]:
+        dividend_exdates: Series,
+        jobs: int = 1,
+        exdate_windows: Optional[Mapping[str, List[DateWindow]]] = None) -> Tuple[List[Dividend], List[Disqualification]]:
     '''Finds dividends which should be disqualified. For any dividends that should be disqualified,
     part or all of the dividend will be split into a new dividend with the proper type. The original
     dividend will be updated to have the proper value
 
     A new list of dividends will be returned, with the updated original dividends as well as the newly
-    created ones.
+    created ones, alongside a record of each disqualification that was made. Securities are processed
+    in symbol order, so the output is the same no matter how many jobs are used.
 
     :param all_lots: Should be a collection of all lots.
     :param securities_with_qual_divs: Should be a collection of securities which had Qualified or Section 199A dividends.
+    :param jobs: The number of processes across which to search for disqualifying lots, if the search is large enough
+        (see MIN_PARALLEL_COST). Everything else runs on the calling process.
+    :param exdate_windows: The windows, by symbol, for which dividend_exdates were fetched. Dividends whose exdate
+        windows weren't fetched can't be disqualified, so they pass through unchanged.
     '''
 
     processed_dividends = [d for d in dividends if not is_qualified(d)]
-    adjustment_occurred = False
+    disqualifications: List[Disqualification] = []
+
+    # group the dividends and lots by symbol in a single pass, rather than scanning them for every security.
+    # Only short lots can disqualify anything, so the others aren't kept
+    qualified_by_symbol: Dict[str, List[Dividend]] = {}
+    related_by_payout: Dict[Tuple[str, datetime], List[Dividend]] = {}
+    for d in dividends:
+        related_by_payout.setdefault((d.symbol, d.date), []).append(d)
+        if is_qualified(d):
+            qualified_by_symbol.setdefault(d.symbol, []).append(d)
+    short_lots_by_symbol: Dict[str, List[ClosedLot]] = {}
+    for lot in all_lots:
+        if lot.holding_period < 61:
+            short_lots_by_symbol.setdefault(cast(str, lot.security_id.symbol), []).append(lot)
+
+    # exdates are only fetched for securities with short lots; the others can't be disqualified. They're split by
+    # symbol once, as indexing the whole series for every dividend is far slower than the lot search itself
+    exdates_by_symbol: Dict[str, Series] = {
+        cast(str, symbol): symbol_exdates.droplevel(0) for symbol, symbol_exdates in dividend_exdates.groupby(level=0)}
+
+    # dividends which pass through unchanged, interleaved (in output order) with those which need evaluating
+    pending: List[Union[Dividend, int]] = []
+    evaluations: List[Evaluation] = []
 
     # ensure that each security gets dealt with once
-    securities_with_qual_divs = set(securities_with_qual_divs)
+    securities_with_qual_divs = sorted(set(securities_with_qual_divs), key=lambda sec: cast(str, sec.symbol))
     for sec in securities_with_qual_divs:
-        qualified_relevant_dividends = [d for d in dividends if d.security_id == sec
-                                        and is_qualified(d)]
-        for div in qualified_relevant_dividends:
-            cusip_exdate_infos: Series = dividend_exdates[div.symbol]
-            exdate = get_dividend_exdate(div, cusip_exdate_infos)
-            if exdate:
-                '''Caveat: Assume that securities analyzed are common stock
-                Qualified Dividends
-                > If the payment is from a common stock you are required to have held it for more than 60 days
-                > during the 121-day period that begins 60 days before the ex-dividend date of the dividend
-                Section 199A Dividends
-                > The QBID may not be taken for any dividend reported in box 5 for dividends received on a share
-                > of REIT or RIC stock that is held for 45 days or less during the 91-day period beginning on the
-                > date that is 45 days before the date on which such share became ex-dividend with respect to the dividend
-
-                To get a dividend, you must hold the stock on the exdate. Therefore, the question of whether a stock
-                was held for 61 (or 46) of the 121 days can be rephrased as whether the exdate fell within any holding periods
-                shorter than 61 (or 46) days. Any holding periods longer than 60 (45) days containing the exdate are naturally ok,
-                and any short holding periods not containing the exdate wouldn't have resulted in any dividends in the
-                first place.
-
-                The holder of the stock at closing the day before the exdate / at opening the day of the exdate is the
-                recipient of the dividend. Therefore, the open date comparison is non-inclusive (buying the stock on the
-                exdate doesn't give you the dividend) but the close date comparison is inclusive (selling the stock on the
-                exdate still gives you the dividend).
-                '''
-                disqualified_lots = [
-                    lot for lot in all_lots
-                    if lot.security_id == sec and lot.open_date < exdate and exdate <= lot.close_date
-                    and ((div.type == DividendType.Qualified and lot.holding_period < 61)
-                         or (div.type == DividendType.Section_199A and lot.holding_period < 46))
-                ]
+        qualified_relevant_dividends = qualified_by_symbol.get(cast(str, sec.symbol), [])
+        if sec.symbol not in exdates_by_symbol:
+            pending.extend(qualified_relevant_dividends)
+            continue
 
+        security_lots = short_lots_by_symbol.get(cast(str, sec.symbol), [])
+        for div in qualified_relevant_dividends:
+            if exdate_windows is not None and not covers(exdate_windows.get(div.symbol, []), exdate_window(div.date)):
+                pending.append(div)
+                continue
+
+            exdate = get_dividend_exdate(div, exdates_by_symbol[div.symbol])
+            if exdate is None:
+                # without an exdate the dividend can't be evaluated, so pass it through unchanged
+                pending.append(div)
+            else:
+                pending.append(len(evaluations))
+                evaluations.append((div, exdate, security_lots))
+
+    all_disqualified_lots = find_all_disqualified_lots(evaluations, jobs) if len(evaluations) > 0 else []
+
+    for item in pending:
+        if isinstance(item, Dividend):
+            processed_dividends.append(item)
+            continue
+
+        div, exdate, _ = evaluations[item]
+        disqualified_lots = all_disqualified_lots[item]
+        div.add_exdate(exdate)
+
+        if len(disqualified_lots) > 0:
+            related_dividends = related_by_payout[(div.symbol, div.date)]
+            qdiv, dqdiv, disqualification = split_disqualified_dividend(
+                div, exdate, exdates_by_symbol[div.symbol][exdate.date()], related_dividends, disqualified_lots)
+
+            processed_dividends.append(qdiv)
+            processed_dividends.append(dqdiv)
+            disqualifications.append(disqualification)
+        else:
+            processed_dividends.append(div)
+    return (processed_dividends, disqualifications)
+
+
+def analyze_dividends(
+        lots: Iterable,
+        dividends: Iterable,
+        repository: SecurityRepository,
+        tax_year: int,
+        open_date_name: str = "Open Date",
+        close_date_name: str = "Close Date",
+        jobs: int = 1,
+        prefetch: bool = True) -> AnalysisResult:
+    '''Analyzes in-memory closed lots and dividends, disqualifying dividends received on shares which
+    weren't held long enough. No files are read or written, unless lots or dividends are lazily read from them.
+
+    :param lots: ClosedLot instances, or a DataFrame, record array or iterable of mappings with symbol, cusip,
+        quantity and the open/close date columns named by open_date_name and close_date_name.
+    :param dividends: Dividend instances, or a DataFrame, record array or iterable of mappings using the
+        standard FieldName columns.
+    :param repository: Used to resolve symbols from CUSIPs and to look up dividend exdates.
+    :param tax_year: The year being analyzed. Only qualified dividends paid in it are checked, and exdates are looked
+        up just in the windows before their payout dates which short lots could have been open across, so they may
+        fall in the year before. Dividends paid in other years are passed through unchanged.
+    :param jobs: The number of processes across which to search for disqualifying lots.
+    :param prefetch: Whether to look up symbols and exdates in the background as lots and dividends are read,
+        which overlaps the lookups with parsing when lots and dividends are lazy iterables.
+    '''
+    # symbols and exdates are looked up in the background while the rest of the input is read. The dividends are
+    # read first, as their CUSIPs and payout dates are what the lookups need, so that those overlap with reading the
+    # lots, which are usually the larger input
+    payout_window = tax_year_window(tax_year)
+    prefetcher = PrefetchingRepository(repository, payout_window=payout_window) if prefetch else None
+    observed_repository = prefetcher or repository
+    try:
+        all_dividends: List[Dividend] = []
+        for div in iter_dividend_records(dividends):
+            if prefetcher:
+                prefetcher.observe_dividend(div)
+            all_dividends.append(div)
+
+        closed_lots: List[ClosedLot] = []
+        for lot in iter_closed_lot_records(lots, open_date_name, close_date_name):
+            # lots are referred to by ID in the disqualification records
+            if lot.lot_id is None:
+                lot.lot_id = str(len(closed_lots))
+            if prefetcher:
+                prefetcher.observe_lot(lot)
+            closed_lots.append(lot)
+
+        # hydrate all the security identifiers. Those of unknown securities can't be analyzed, so their lots are
+        # ignored and their dividends pass through unchanged
+        unresolved_cusips: Set[str] = set()
+        for security_id in chain((lot.security_id for lot in closed_lots), (div.security_id for div in all_dividends)):
+            hydrate_or_note(security_id, observed_repository, unresolved_cusips)
+        log_unresolved(unresolved_cusips)
+        input_dividends = all_dividends
+        closed_lots = [lot for lot in closed_lots if lot.security_id.symbol]
+        unresolved_dividends = [d for d in all_dividends if not d.security_id.symbol]
+        all_dividends = [d for d in all_dividends if d.security_id.symbol]
+
+        # get all securities that had qualified dividends or section 199a dividends
+        securities_with_qual_divs = set([d.security_id for d in all_dividends
+                                        if is_qualified(d)])
+
+        # get closed lots for those securities which had short holding periods
+        lots_with_short_holding_periods = [lot for lot in closed_lots
+                                           if lot.security_id in securities_with_qual_divs and lot.holding_period < 61]
+
+        # plan the windows of dates in which the exdates of those securities could matter
+        planner = ExdatePlanner(payout_window)
+        for lot in lots_with_short_holding_periods:
+            planner.add_short_lot(cast(str, lot.security_id.symbol), lot.open_date, lot.close_date)
+        qualified_dividends = [div for div in all_dividends if is_qualified(div)]
+        for div in qualified_dividends:
+            planner.add_payout(div.symbol, div.date)
+        log_outside_tax_year(sum(not planner.plans(div.date) for div in qualified_dividends), tax_year)
+        exdate_windows = planner.windows()
+
+        if len(exdate_windows) == 0:
+            return AnalysisResult(input_dividends, [])
+
+        dividend_exdates = observed_repository.get_dividend_exdates_in_windows(exdate_windows)
+    finally:
+        # stop the lookup threads before any worker processes are started
+        if prefetcher:
+            prefetcher.close()
+
+    if dividend_exdates is None:
+        raise Exception("Encountered an error fetching dividend exdate information")
+
+    new_dividends, disqualifications = identify_and_separate_disqualified_dividends(
+        all_dividends,
+        closed_lots,
+        securities_with_qual_divs,
+        dividend_exdates,
+        jobs,
+        exdate_windows
+    )
+    return AnalysisResult(new_dividends + unresolved_dividends, disqualifications)
+
+
+def analyze_dividends_out_of_core(
+        lots: Iterable[ClosedLot],
+        dividends: Iterable[Dividend],
+        repository: SecurityRepository,
+        tax_year: int,
+        max_records: int,
+        on_disqualification: Callable[[Disqualification], None]) -> Iterator[Dividend]:
+    '''Analyzes lots and dividends which may not fit in memory, lazily yielding the adjusted dividends.
+
+    Dividends and short lots are externally sorted by (symbol, date) into on-disk runs holding at most max_records
+    each, then merge-joined one security at a time. Exdates only move forward as a security's payout dates do,
+    so the lots considered for a dividend are a sliding window of short lots open across its exdate.
+
+    The adjusted dividends match those of analyze_dividends, but are yielded grouped by symbol and payout date.
+    Each disqualification is passed to on_disqualification as it's made rather than collected, so that the caller can
+    count, spill or stream them without holding them all in memory.
+    '''
+    # symbols and exdates are looked up in the background while the rest of the input is read
+    payout_window = tax_year_window(tax_year)
+    prefetcher = PrefetchingRepository(repository, payout_window=payout_window)
+    try:
+        yield from _merge_join_out_of_core(lots, dividends, prefetcher, tax_year, max_records, on_disqualification)
+    finally:
+        prefetcher.close()
+
+
+def _observe_ahead(
+        items: Iterable[T],
+        observe: Callable[[T], None],
+        hydrate: Callable[[T], None],
+        lookahead: int) -> Iterator[T]:
+    '''Observes each item as it's read, but only hydrates and yields it once up to lookahead more items have been
+    read and observed. Lookups started by observing them then overlap with parsing, rather than being waited on
+    one at a time, while holding at most lookahead items in memory.'''
+    pending: Deque[T] = deque()
+    for item in items:
+        observe(item)
+        pending.append(item)
+        if len(pending) > lookahead:
+            ready = pending.popleft()
+            hydrate(ready)
+            yield ready
+    while len(pending) > 0:
+        ready = pending.popleft()
+        hydrate(ready)
+        yield ready
+
+
+def _merge_join_out_of_core(
+        lots: Iterable[ClosedLot],
+        dividends: Iterable[Dividend],
+        repository: PrefetchingRepository,
+        tax_year: int,
+        max_records: int,
+        on_disqualification: Callable[[Disqualification], None]) -> Iterator[Dividend]:
+    # pass over the dividends: resolve their symbols and note which securities can be disqualified at all
+    symbols_with_qual_divs: Set[str] = set()
+    unresolved_cusips: Set[str] = set()
+    planner = ExdatePlanner(tax_year_window(tax_year))
+    outside_tax_year = 0
+
+    def hydrated_dividends() -> Iterator[Tuple[int, Dividend]]:
+        observed_dividends = _observe_ahead(
+            dividends, repository.observe_dividend,
+            lambda div: hydrate_or_note(div.security_id, repository, unresolved_cusips), max_records)
+        nonlocal outside_tax_year
+        for seq, div in enumerate(observed_dividends):
+            if is_qualified(div) and div.security_id.symbol:
+                if planner.plans(div.date):
+                    symbols_with_qual_divs.add(div.symbol)
+                    planner.add_payout(div.symbol, div.date)
+                else:
+                    outside_tax_year += 1
+            yield seq, div
+
+    # dividends of unknown securities sort first, and pass through unchanged
+    sorted_dividends = external_sort(
+        hydrated_dividends(), lambda x: (x[1].security_id.symbol or "", x[1].date, x[0]), max_records)
+    # the first item can only be produced after every dividend has been consumed
+    first_dividend = next(sorted_dividends, None)
+    if first_dividend is None:
+        return
+    log_outside_tax_year(outside_tax_year, tax_year)
+    sorted_dividends = chain([first_dividend], sorted_dividends)
+
+    # pass over the lots: only short lots of securities with qualified dividends are kept
+    def short_lots() -> Iterator[Tuple[int, ClosedLot]]:
+        observed_lots = _observe_ahead(
+            lots, repository.observe_lot,
+            lambda lot: hydrate_or_note(lot.security_id, repository, unresolved_cusips), max_records)
+        for seq, lot in enumerate(observed_lots):
+            if lot.lot_id is None:
+                lot.lot_id = str(seq)
+            if lot.holding_period < 61 and lot.security_id.symbol in symbols_with_qual_divs:
+                planner.add_short_lot(cast(str, lot.security_id.symbol), lot.open_date, lot.close_date)
+                yield seq, lot
+
+    sorted_lots = external_sort(short_lots(), lambda x: (x[1].security_id.symbol, x[1].open_date, x[0]), max_records)
+    first_lot = next(sorted_lots, None)
+    log_unresolved(unresolved_cusips)
+
+    if first_lot is None:
+        yield from (div for _, div in sorted_dividends)
+        return
+
+    # the short lot pass is complete, so all the windows that need exdates are known
+    exdate_windows = planner.windows()
+    dividend_exdates = repository.get_dividend_exdates_in_windows(exdate_windows)
+    if dividend_exdates is None:
+        raise Exception("Encountered an error fetching dividend exdate information")
+    symbols_with_exdates = set(dividend_exdates.index.get_level_values(0))
+
+    remaining_lots = iter(sorted_lots)
+    next_lot: Optional[Tuple[int, ClosedLot]] = first_lot
+    for symbol, symbol_dividends in groupby((div for _, div in sorted_dividends), key=lambda d: d.security_id.symbol):
+        if not symbol or symbol not in symbols_with_exdates:
+            yield from symbol_dividends
+            continue
+
+        # skip the lots of securities which sort before this one
+        while next_lot is not None and cast(str, next_lot[1].security_id.symbol) < symbol:
+            next_lot = next(remaining_lots, None)
+
+        cusip_exdate_infos: Series = dividend_exdates[symbol]
+        window: List[Tuple[int, ClosedLot]] = []
+        for _, related in groupby(symbol_dividends, key=lambda d: d.date):
+            related_dividends = list(related)
+            for div in related_dividends:
+                fetched = is_qualified(div) and covers(exdate_windows[symbol], exdate_window(div.date))
+                exdate = get_dividend_exdate(div, cusip_exdate_infos) if fetched else None
+                if exdate is None:
+                    yield div
+                    continue
+
+                # slide the window up to the exdate
+                while next_lot is not None and next_lot[1].security_id.symbol == symbol and next_lot[1].open_date < exdate:
+                    window.append(next_lot)
+                    next_lot = next(remaining_lots, None)
+                window = [(seq, lot) for seq, lot in window if exdate <= lot.close_date]
+
+                # list the lots in input order, as analyze_dividends does
+                disqualified_lots = find_disqualified_lots(div, exdate, [lot for _, lot in sorted(window, key=lambda x: x[0])])
                 div.add_exdate(exdate)
 
                 if len(disqualified_lots) > 0:
-                    # sometimes a fraction of the dividend is qualified. Calculate the total for the security
-                    # on the dividend date to then quanitfy what fraction of the dividend was qualified
-                    related_dividends = [d for d in dividends if d.security_id == sec and d.date == div.date]
-
-                    # purposefully avoid the foreign tax withheld values
-                    total_dividend_amount = sum(d.value for d in related_dividends if d.value > 0)
-                    qualified_percentage = div.value / total_dividend_amount
-
-                    dividend_value_per_share = cusip_exdate_infos[exdate.date()]
-
-                    # create a new dividend from the disqualified value of the old one
-                    disqualified_shares = sum(lot.quantity for lot in disqualified_lots)
-                    disqualified_value = round(disqualified_shares * dividend_value_per_share * qualified_percentage, 2)
-                    qdiv, dqdiv = div.disqualify(disqualified_value)
-
-                    min_holding_period, relevant_period = (61, 121) if div.type == DividendType.Qualified else (46, 91)
-                    list_sep = "\n\t - "
-                    qdiv.add_note((f"Disqualified ${disqualified_value} from {div.type.value}. The dividend on {exdate.date()} had value"
-                                  f" ${dividend_value_per_share} per share. {qualified_percentage * 100:0.2f}% of the dividend"
-                                  f" value was classified as {div.type.value}. {disqualified_shares} shares were not held for"
-                                  f" {min_holding_period} days of the relevant {relevant_period} day period, which are as follows:"
-                                  f"\n\t - {list_sep.join(map(str, disqualified_lots))}\n"
-                    ))
-                    dqdiv.add_note(f"Synthesized nonqualified dividend due to:\n\t - {list_sep.join(map(str, disqualified_lots))}")
-
-                    processed_dividends.append(qdiv)
-                    processed_dividends.append(dqdiv)
-                    adjustment_occurred = True
+                    qdiv, dqdiv, disqualification = split_disqualified_dividend(
+                        div, exdate, cusip_exdate_infos[exdate.date()], related_dividends, disqualified_lots)
+                    on_disqualification(disqualification)
+                    yield qdiv
+                    yield dqdiv
                 else:
-                    processed_dividends.append(div)
-    return (processed_dividends, adjustment_occurred)
+                    yield div
 
 
 def analyze_qualified_dividends(args: Namespace):
     logger.info("Running qualified dividends analysis")
-    yahoo_repository = YahooRepository()
-
-    # read all input CSVs
-    flattened_lots_files = chain.from_iterable(args.lots)
-    flattened_dividends_files = chain.from_iterable(args.dividends)
-    closed_lots: List[ClosedLot] = reduce(lambda acc, next: acc + read_closed_lots(next), flattened_lots_files, [])
-    dividends: List[Dividend] = reduce(lambda acc, next: acc + read_dividends(next), flattened_dividends_files, [])
-
-    # hydrate all the security identifiers
-    list(map(lambda x: x.hydrate(yahoo_repository), [lots.security_id for lots in closed_lots]))
-    list(map(lambda x: x.hydrate(yahoo_repository), [divs.security_id for divs in dividends]))
-
-    # get all securities that had qualified dividends or section 199a dividends
-    securities_with_qual_divs = set([d.security_id for d in dividends
-                                    if is_qualified(d)])
+    # the user is prompted by the tiered repository, once any hedged requests have raced, never by the remotes
+    repository = TieredRepository(
+        YahooRepository(interactive=False),
+        cache_path=None if args.no_cache else args.cache,
+        hedge_after=args.hedge_after,
+        interactive=True,
+    )
+    try:
+        _analyze_qualified_dividend_files(args, repository)
+    finally:
+        repository.log_stats()
+        repository.close()
 
-    # get closed lots for those securities which had short holding periods
-    lots_with_short_holding_periods = [lot for lot in closed_lots
-                                       if lot.security_id in securities_with_qual_divs and lot.holding_period < 61]
+    logger.info("Analysis complete")
 
-    if len(lots_with_short_holding_periods) > 0:
-        # fetch dividend information those securities with holding periods less than 60 days
-        dividend_exdates = yahoo_repository.get_dividend_exdates(
-            [lot.security_id for lot in lots_with_short_holding_periods if lot.holding_period < 61],
-            args.year
-        )
 
-        if dividend_exdates is None:
-            raise Exception("Encountered an error fetching dividend exdate information")
+def _analyze_qualified_dividend_files(args: Namespace, repository: SecurityRepository):
+    # the input CSVs are read lazily, so that lookups overlap with reading the rest of them
+    lots = chain.from_iterable(map(iter_closed_lots, chain.from_iterable(args.lots)))
+    dividends = chain.from_iterable(map(iter_dividends, chain.from_iterable(args.dividends)))
+
+    if args.max_records:
+        # disqualifications are only counted, and spilled to disk for the audit, so memory stays bounded
+        disqualification_count = 0
+        audit_run = open_run() if args.audit_file else None
+
+        def on_disqualification(disqualification: Disqualification):
+            nonlocal disqualification_count
+            disqualification_count += 1
+            if audit_run is not None:
+                append_to_run(audit_run, disqualification)
+
+        try:
+            adjusted_dividends = write_run(analyze_dividends_out_of_core(
+                lots, dividends, repository, args.year, args.max_records, on_disqualification))
+            try:
+                if disqualification_count > 0:
+                    write_dividends(read_run(adjusted_dividends), args.max_note_lots)
+            finally:
+                adjusted_dividends.close()
+
+            if audit_run is not None and disqualification_count > 0:
+                write_disqualifications(read_run(audit_run), args.audit_file)
+        finally:
+            if audit_run is not None:
+                audit_run.close()
+    else:
+        result = analyze_dividends(lots, dividends, repository, args.year, jobs=args.jobs)
 
         # produce an updated csv if there are dividends which have been disqualified
-        new_dividends, adjustment_occurred = identify_and_separate_disqualified_dividends(
-            dividends,
-            closed_lots,
-            securities_with_qual_divs,
-            dividend_exdates
-        )
-
-        if adjustment_occurred:
-            write_dividends(new_dividends)
-
-    logger.info("Analysis complete")
+        if result.adjustment_occurred:
+            write_dividends(result.dividends, args.max_note_lots)
+        if args.audit_file and result.adjustment_occurred:
+            write_disqualifications(result.disqualifications, args.audit_file)
@@ -1,12 +1,15 @@
-
 from abc import ABC, abstractmethod
-from typing import List, Union
+from typing import List, Mapping, Union
 from pandas.core.series import Series
 
-from models.security_identifier import SecurityIdentifier
+from utilities.exdate_windows import DateWindow
 
 
 class DividendExdateRepository(ABC):
+    '''Looks up dividend exdates. Lookups return None if any of the securities couldn't be looked up, so a security
+    missing from a returned series is known not to have had any exdates, and may be cached as such.'''
     @abstractmethod
-    def get_dividend_exdates(self, lookup: Union[SecurityIdentifier, List[SecurityIdentifier]], tax_year: int) -> Union[Series, None]:
+    def get_dividend_exdates_in_windows(self, windows: Mapping[str, List[DateWindow]]) -> Union[Series, None]:
+        '''Gets the exdates of each symbol which fall within its windows, as a series of the dividend per share
+        indexed by symbol and exdate'''
         raise NotImplementedError()
@@ -0,0 +1,174 @@
+from concurrent.futures import Future, ThreadPoolExecutor
+from datetime import datetime
+from time import sleep
+from threading import Lock
+from typing import Dict, List, Mapping, Optional, Tuple, Union, cast
+from pandas import concat
+from pandas.core.series import Series
+from logging import getLogger
+
+from models.closed_lot import ClosedLot
+from models.dividend import Dividend, DividendType
+from models.security_identifier import cusip_to_symbol_cache
+from repositories.security_repository import SecurityRepository
+from utilities.exdate_windows import (COALESCE_GAP, DateWindow, ExdatePlanner, WindowSet, coalesce_windows, empty_exdates,
+                                     select_windows)
+
+logger = getLogger(__name__)
+
+
+class PrefetchingRepository(SecurityRepository):
+    '''Wraps a repository so that its network round trips overlap with reading the input.
+
+    Every lot and dividend should be observed as it's read. CUSIPs are resolved in the background as soon as
+    they're first seen. Qualified payout dates and short lots are planned as they're observed, and the exdate windows
+    the planner turns up are fetched in the background in batches. Windows accumulate for batch_delay seconds, and
+    while a batch is in flight, before being coalesced per symbol (see COALESCE_GAP) and fetched in a single call.
+    Queries fetch whatever is still accumulating straight away, then return the prefetched results, waiting on them
+    if they're in flight, and fall through to the wrapped repository once closed. Only payouts within payout_window,
+    if given, are planned (see ExdatePlanner).
+    '''
+    def __init__(self, repository: SecurityRepository, max_workers: int = 8,
+                 payout_window: Optional[DateWindow] = None, batch_delay: float = 0.05):
+        self._repository = repository
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="prefetch")
+        self._batch_delay = batch_delay
+        self._lock = Lock()
+        self._closed = False
+        self._symbols: Dict[str, Future] = {}  # by cusip
+        self._planner = ExdatePlanner(payout_window)
+        self._requested: Dict[str, WindowSet] = {}  # by symbol
+        self._exdates: Dict[str, List[Tuple[DateWindow, Future]]] = {}  # by symbol
+        self._pending: Dict[str, List[DateWindow]] = {}  # by symbol, planned but not yet requested
+        self._batching = False  # whether the planned windows are being fetched in the background
+
+    def observe_dividend(self, dividend: Dividend):
+        qualified = dividend.type in (DividendType.Qualified, DividendType.Section_199A)
+        symbol = dividend.security_id.symbol
+        cusip = cast(str, dividend.security_id.cusip)
+        if symbol is None and cusip in cusip_to_symbol_cache:
+            symbol = cusip_to_symbol_cache[cusip]
+
+        if symbol is not None:
+            if qualified:
+                self._observe_payout(symbol, dividend.date)
+            return
+
+        future = self._resolve(cusip)
+        if qualified and future is not None:
+            payout_date = dividend.date
+            future.add_done_callback(lambda f: self._on_payout_symbol(f, payout_date))
+
+    def observe_lot(self, lot: ClosedLot):
+        if lot.holding_period < 61 and lot.security_id.symbol is not None:
+            symbol = lot.security_id.symbol
+            with self._lock:
+                if self._closed:
+                    return
+                for window in self._planner.add_short_lot(symbol, lot.open_date, lot.close_date):
+                    self._plan(symbol, window)
+
+    def get_ticker_from_cusip(self, cusip: str) -> str:
+        future = self._resolve(cusip)
+        if future is None or future.cancelled():
+            # after close(), anything not already looked up goes straight to the wrapped repository
+            return self._repository.get_ticker_from_cusip(cusip)
+        return future.result()
+
+    def get_dividend_exdates_in_windows(self, windows: Mapping[str, List[DateWindow]]) -> Union[Series, None]:
+        with self._lock:
+            closed = self._closed
+            if not closed:
+                for symbol, symbol_windows in windows.items():
+                    self._pending.setdefault(symbol, []).extend(symbol_windows)
+                self._fetch_pending()
+                futures = [future for symbol, symbol_windows in windows.items() for window in symbol_windows
+                           for fetched, future in self._exdates.get(symbol, []) if fetched.overlaps(window)]
+        if closed:
+            return self._repository.get_dividend_exdates_in_windows(windows)
+        results = [future.result() for future in dict.fromkeys(futures)]
+        if any(result is None for result in results):
+            return None
+
+        # the fetches may extend past the requested windows
+        found_exdates = [select_windows(result, windows) for result in results if len(result) > 0]
+        if len(found_exdates) == 0:
+            return empty_exdates()
+        return concat(found_exdates)
+
+    def close(self):
+        '''Stops the background lookups. Any which haven't started are cancelled, and nothing more is prefetched.
+        Closing more than once has no effect'''
+        with self._lock:
+            if self._closed:
+                return
+            self._closed = True
+        self._executor.shutdown(wait=True, cancel_futures=True)
+
+    def _resolve(self, cusip: str) -> Optional[Future]:
+        '''Starts looking up the CUSIP, if it isn't already. Returns None if it wasn't looked up before close()'''
+        with self._lock:
+            if cusip not in self._symbols and not self._closed:
+                self._symbols[cusip] = self._executor.submit(self._repository.get_ticker_from_cusip, cusip)
+            return self._symbols.get(cusip)
+
+    def _on_payout_symbol(self, future: Future, payout_date: datetime):
+        # failures surface when the symbol is next asked for, and lookups cancelled by close() are dropped
+        if not future.cancelled() and future.exception() is None:
+            self._observe_payout(future.result(), payout_date)
+
+    def _observe_payout(self, symbol: str, payout_date: datetime):
+        with self._lock:
+            # callbacks of lookups which completed during close() may still arrive
+            if self._closed:
+                return
+            for window in self._planner.add_payout(symbol, payout_date):
+                self._plan(symbol, window)
+
+    def _plan(self, symbol: str, window: DateWindow):
+        '''Queues the window to be fetched in the background. Must be called with the lock held'''
+        self._pending.setdefault(symbol, []).append(window)
+        if not self._batching:
+            self._batching = True
+            self._executor.submit(self._fetch_batches)
+
+    def _fetch_batches(self):
+        '''Fetches the planned windows one batch at a time, until none are left. Waiting before taking each batch
+        lets windows planned together, such as those of CUSIPs resolved at about the same time, share a call'''
+        while True:
+            sleep(self._batch_delay)
+            with self._lock:
+                batch = self._take_pending() if not self._closed else {}
+                if len(batch) == 0:
+                    self._batching = False
+                    return
+                future: Future = Future()
+                self._add_fetch(batch, future)
+            try:
+                future.set_result(self._repository.get_dividend_exdates_in_windows(batch))
+            except BaseException as e:
+                future.set_exception(e)
+
+    def _fetch_pending(self):
+        '''Starts fetching the queued windows straight away. Must be called with the lock held'''
+        batch = self._take_pending()
+        if len(batch) > 0:
+            self._add_fetch(batch, self._executor.submit(self._repository.get_dividend_exdates_in_windows, batch))
+
+    def _take_pending(self) -> Dict[str, List[DateWindow]]:
+        '''Takes the parts of the queued windows which haven't already been requested, coalesced per symbol.
+        Must be called with the lock held'''
+        batch: Dict[str, List[DateWindow]] = {}
+        for symbol, windows in self._pending.items():
+            requested = self._requested.setdefault(symbol, WindowSet())
+            gaps = [gap for window in coalesce_windows(windows, COALESCE_GAP) for gap in requested.add(window)]
+            if len(gaps) > 0:
+                batch[symbol] = gaps
+        self._pending = {}
+        return batch
+
+    def _add_fetch(self, batch: Dict[str, List[DateWindow]], future: Future):
+        logger.debug("Prefetching dividend exdates in %d windows of %s", sum(map(len, batch.values())),
+                     ','.join(batch))
+        for symbol, gaps in batch.items():
+            self._exdates.setdefault(symbol, []).extend((gap, future) for gap in gaps)
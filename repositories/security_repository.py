@@ -0,0 +1,9 @@
+from abc import ABC
+
+from repositories.dividend_exdate_repository import DividendExdateRepository
+from repositories.symbol_repository import SecurityNotFound, SymbolRepository  # noqa: F401
+
+
+class SecurityRepository(DividendExdateRepository, SymbolRepository, ABC):
+    '''A repository which can both resolve symbols and supply dividend exdates, as the analysis requires both'''
+    pass
@@ -1,8 +1,21 @@
-
 from abc import ABC, abstractmethod
+from typing import List
+
+
+class SecurityNotFound(LookupError):
+    '''Raised by a repository which knows that a CUSIP or symbol doesn't exist'''
+    pass
 
 
 class SymbolRepository(ABC):
     @abstractmethod
     def get_ticker_from_cusip(self, cusip: str) -> str:
         raise NotImplementedError()
+
+    def get_ticker_candidates(self, cusip: str) -> List[str]:
+        '''Gets every symbol the CUSIP may refer to without asking the user anything, so it's safe to retry or race.
+        Empty if the CUSIP is known not to have any'''
+        try:
+            return [self.get_ticker_from_cusip(cusip)]
+        except SecurityNotFound:
+            return []
@@ -0,0 +1,281 @@
+import shelve
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from dataclasses import dataclass, field
+from datetime import datetime, timedelta
+from threading import Lock
+from time import perf_counter
+from typing import Callable, Dict, List, Mapping, MutableMapping, Optional, Tuple, TypeVar, Union, cast
+from pandas import concat
+from pandas.core.series import Series
+from logging import getLogger
+
+from repositories.security_repository import SecurityNotFound, SecurityRepository
+from utilities.exdate_windows import DateWindow, WindowSet, empty_exdates, select_windows
+from utilities.user_selection import choose_ticker
+
+logger = getLogger(__name__)
+
+T = TypeVar("T")
+
+
+@dataclass
+class TierStats:
+    '''Lookup counters for one tier of a TieredRepository'''
+    hits: int = 0
+    misses: int = 0
+    total_latency: float = 0.0  # seconds
+    hedges: int = 0
+    hedge_wins: int = 0
+
+    @property
+    def lookups(self) -> int:
+        return self.hits + self.misses
+
+    @property
+    def hit_rate(self) -> float:
+        return self.hits / self.lookups if self.lookups > 0 else 0.0
+
+    @property
+    def mean_latency(self) -> float:
+        return self.total_latency / self.lookups if self.lookups > 0 else 0.0
+
+
+@dataclass
+class CachedExdates:
+    '''The exdates of a symbol, along with the ranges of dates they were fetched over. The ranges are kept coalesced,
+    each with when its oldest part was fetched, as a range without any exdates is only trusted for negative_ttl.'''
+    symbol: str
+    covered: List[Tuple[DateWindow, datetime]] = field(default_factory=list)
+    exdates: Series = field(default_factory=empty_exdates)
+
+    def valid_ranges(self, negative_ttl: timedelta) -> List[DateWindow]:
+        now = datetime.now()
+        return [window for window, fetched_at in self.covered
+                if now - fetched_at <= negative_ttl or len(select_windows(self.exdates, {self.symbol: [window]})) > 0]
+
+    def add(self, windows: List[DateWindow], exdates: Series, negative_ttl: timedelta) -> "CachedExdates":
+        '''Returns a copy which also covers the windows, whose exdates were just fetched. Ranges which are no longer
+        trusted are dropped.'''
+        fetched_at = datetime.now()
+        valid = set(self.valid_ranges(negative_ttl))
+        covered: List[Tuple[DateWindow, datetime]] = []
+        for window, window_fetched_at in sorted([(window, at) for window, at in self.covered if window in valid]
+                                                + [(window, fetched_at) for window in windows]):
+            if len(covered) > 0 and window.start <= covered[-1][0].end:
+                last, last_fetched_at = covered[-1]
+                covered[-1] = (DateWindow(last.start, max(last.end, window.end)), min(last_fetched_at, window_fetched_at))
+            else:
+                covered.append((window, window_fetched_at))
+
+        found_exdates = [found for found in (select_windows(self.exdates, {self.symbol: list(valid)}), exdates)
+                         if len(found) > 0]
+        return CachedExdates(self.symbol, covered,
+                             concat(found_exdates).sort_index() if len(found_exdates) > 0 else empty_exdates())
+
+
+class CacheTier:
+    '''A tier of cached lookups, held in memory or, given a path, persisted on disk in a shelf.
+    A cached None records that the remote reported nothing for the key.'''
+    def __init__(self, name: str, path: Optional[str] = None):
+        self.name = name
+        self._store: MutableMapping[str, Tuple[object, datetime]] = shelve.open(path) if path else {}
+        self._lock = Lock()
+
+    def get(self, key: str, negative_ttl: timedelta) -> Tuple[bool, object]:
+        '''Gets (whether the key is cached, its value). Missing entries older than negative_ttl aren't returned'''
+        with self._lock:
+            entry = self._store.get(key)
+        if entry is None:
+            return False, None
+        value, stored_at = entry
+        if value is None and datetime.now() - stored_at > negative_ttl:
+            return False, None
+        return True, value
+
+    def put(self, key: str, value: object):
+        with self._lock:
+            self._store[key] = (value, datetime.now())
+
+    def close(self):
+        with self._lock:
+            if isinstance(self._store, shelve.Shelf):
+                self._store.close()
+
+
+class TieredRepository(SecurityRepository):
+    '''Chains lookups through an in-memory tier, an optional persistent tier and finally the remote repository,
+    filling the faster tiers with whatever the slower ones return.
+
+    CUSIPs and symbols the remote reports as missing are cached too (for negative_ttl), so they aren't searched
+    for again. When hedge_after is set, a remote lookup that hasn't completed within that many seconds is raced
+    against a second request (to the backup repository, if given) and the first to succeed is used. Each request
+    may prompt the user if the remotes are interactive, so hedged remotes shouldn't be. Instead, when interactive is
+    set, CUSIP lookups only race the remotes' non-interactive searches for candidate symbols, and the user is asked
+    to pick one (or enter one, if there are none) once, after the race.
+    '''
+    def __init__(
+        self,
+        remote: SecurityRepository,
+        cache_path: Optional[str] = None,
+        negative_ttl: timedelta = timedelta(days=30),
+        hedge_after: Optional[float] = None,
+        backup: Optional[SecurityRepository] = None,
+        interactive: bool = False,
+    ):
+        self._tiers = [CacheTier("memory")]
+        if cache_path:
+            self._tiers.append(CacheTier("persistent", cache_path))
+        self._remote = remote
+        self._backup = backup or remote
+        self._negative_ttl = negative_ttl
+        self._hedge_after = hedge_after
+        self._interactive = interactive
+        self._executor = ThreadPoolExecutor(thread_name_prefix="hedge") if hedge_after is not None else None
+        self._stats_lock = Lock()
+        self._exdates_lock = Lock()
+        self.stats: Dict[str, TierStats] = {tier.name: TierStats() for tier in self._tiers}
+        self.stats["remote"] = TierStats()
+
+    def get_ticker_from_cusip(self, cusip: str) -> str:
+        key = f"symbol:{cusip}"
+        found, symbol = self._lookup_tiers(key)
+        if self._interactive and (not found or symbol is None):
+            # CUSIPs known to be missing skip straight to asking the user
+            candidates: List[str] = []
+            if not found:
+                start = perf_counter()
+                candidates = self._query_remote(lambda repository: repository.get_ticker_candidates(cusip))
+                self._record("remote", len(candidates) > 0, perf_counter() - start)
+            symbol = choose_ticker(cusip, candidates)
+            self._fill_tiers(key, symbol)
+        elif not found:
+            start = perf_counter()
+            try:
+                symbol = self._query_remote(lambda repository: repository.get_ticker_from_cusip(cusip))
+            except SecurityNotFound:
+                self._record("remote", False, perf_counter() - start)
+                self._fill_tiers(key, None)
+                raise
+            self._record("remote", True, perf_counter() - start)
+            self._fill_tiers(key, symbol)
+
+        if symbol is None:
+            raise SecurityNotFound(f"CUSIP {cusip} is known not to have a ticker")
+        return cast(str, symbol)
+
+    def get_dividend_exdates_in_windows(self, windows: Mapping[str, List[DateWindow]]) -> Union[Series, None]:
+        # each symbol's exdates are cached with the ranges of dates they cover, so any window within those ranges is
+        # served from the cache however the windows were requested before
+        cached: Dict[str, CachedExdates] = {}
+        missing: Dict[str, List[DateWindow]] = {}
+        for symbol, symbol_windows in windows.items():
+            cached[symbol], gaps = self._lookup_exdate_tiers(symbol, symbol_windows)
+            if len(gaps) > 0:
+                missing[symbol] = gaps
+
+        if len(missing) > 0:
+            start = perf_counter()
+            remote_exdates = self._query_remote(lambda repository: repository.get_dividend_exdates_in_windows(missing))
+            self._record("remote", remote_exdates is not None, perf_counter() - start)
+            if remote_exdates is None:
+                return None
+
+            with self._exdates_lock:
+                for symbol, gaps in missing.items():
+                    # other lookups may have added to the symbol's entry since it was read
+                    current, _ = self._lookup_exdate_tiers(symbol, [], record=False)
+                    cached[symbol] = current.add(gaps, select_windows(remote_exdates, {symbol: gaps}),
+                                                 self._negative_ttl)
+                    self._fill_tiers(f"exdates:{symbol}", cached[symbol])
+
+        found_exdates = [select_windows(cached[symbol].exdates, {symbol: symbol_windows})
+                         for symbol, symbol_windows in windows.items()]
+        found_exdates = [found for found in found_exdates if len(found) > 0]
+        if len(found_exdates) == 0:
+            return empty_exdates()
+        return concat(found_exdates)
+
+    def log_stats(self):
+        for name, stats in self.stats.items():
+            logger.info("Repository tier %s: %d/%d hits (%.0f%%), mean latency %.1fms%s", name, stats.hits, stats.lookups,
+                        stats.hit_rate * 100, stats.mean_latency * 1000,
+                        f", {stats.hedges} hedged requests ({stats.hedge_wins} won)" if stats.hedges > 0 else "")
+
+    def close(self):
+        '''Closes the persistent tier, saving it to disk'''
+        for tier in self._tiers:
+            tier.close()
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+
+    def _lookup_tiers(self, key: str) -> Tuple[bool, object]:
+        for idx, tier in enumerate(self._tiers):
+            start = perf_counter()
+            found, value = tier.get(key, self._negative_ttl)
+            self._record(tier.name, found, perf_counter() - start)
+            if found:
+                # promote the value to the faster tiers
+                for faster_tier in self._tiers[:idx]:
+                    faster_tier.put(key, value)
+                return True, value
+        return False, None
+
+    def _lookup_exdate_tiers(self, symbol: str, windows: List[DateWindow], record: bool = True) \
+            -> Tuple[CachedExdates, List[DateWindow]]:
+        '''Finds the cached exdates of the symbol in the fastest tier which covers all the windows, returning them
+        with the parts of the windows they don't cover. A tier only counts as a hit if it covers every window.'''
+        entry = CachedExdates(symbol)
+        gaps = list(windows)
+        for idx, tier in enumerate(self._tiers):
+            start = perf_counter()
+            found, value = tier.get(f"exdates:{symbol}", self._negative_ttl)
+            if found:
+                entry = cast(CachedExdates, value)
+                covered = WindowSet()
+                covered.windows = entry.valid_ranges(self._negative_ttl)
+                gaps = [gap for window in windows for gap in covered.add(window)]
+            if record:
+                self._record(tier.name, found and len(gaps) == 0, perf_counter() - start)
+            if found and len(gaps) == 0:
+                for faster_tier in self._tiers[:idx]:
+                    faster_tier.put(f"exdates:{symbol}", entry)
+                break
+        return entry, gaps
+
+    def _fill_tiers(self, key: str, value: object):
+        for tier in self._tiers:
+            tier.put(key, value)
+
+    def _query_remote(self, query: Callable[[SecurityRepository], T]) -> T:
+        if self._executor is None:
+            return query(self._remote)
+
+        primary = self._executor.submit(query, self._remote)
+        done, _ = wait([primary], timeout=self._hedge_after)
+        if primary in done:
+            return primary.result()
+
+        logger.debug("Remote lookup exceeded %ss, sending a hedged request", self._hedge_after)
+        backup = self._executor.submit(query, self._backup)
+        with self._stats_lock:
+            self.stats["remote"].hedges += 1
+
+        pending = {primary, backup}
+        while True:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            # prefer a successful result, but surface the error if both requests failed
+            for future in sorted(done, key=lambda f: f.exception() is not None):
+                if future.exception() is None or len(pending) == 0:
+                    if future is backup and future.exception() is None:
+                        with self._stats_lock:
+                            self.stats["remote"].hedge_wins += 1
+                    return future.result()
+
+    def _record(self, tier: str, hit: bool, latency: float):
+        with self._stats_lock:
+            stats = self.stats[tier]
+            if hit:
+                stats.hits += 1
+            else:
+                stats.misses += 1
+            stats.total_latency += latency
@@ -1,84 +1,88 @@
-from typing import List, Union, cast
+from typing import Dict, List, Mapping, Union
 from yahooquery import Ticker, search  # type: ignore
+from pandas import DataFrame, concat
 from pandas.core.series import Series
 from datetime import datetime
-from logging import getLogger
+from logging import getLogger, DEBUG
 
-from models.security_identifier import SecurityIdentifier
-from repositories.dividend_exdate_repository import DividendExdateRepository
-from repositories.symbol_repository import SymbolRepository
-from utilities.user_selection import user_selector
+from repositories.security_repository import SecurityNotFound, SecurityRepository
+from utilities.exdate_windows import COALESCE_GAP, DateWindow, coalesce_windows, empty_exdates, select_windows
+from utilities.user_selection import choose_ticker
 
 
 logger = getLogger(__name__)
 
 
-class YahooRepository(DividendExdateRepository, SymbolRepository):
-    def __init__(self):
-        pass
-
-    def get_dividend_exdates(self, query: Union[SecurityIdentifier, List[SecurityIdentifier]], tax_year: int) -> Union[Series, None]:
-        """ Gets the dividend history for the specified tax year
-
+class YahooRepository(SecurityRepository):
+    def __init__(self, interactive: bool = True):
+        '''
         Keyword Arguments:
-        security_ids -- the security identifier (or a list, for multiple)
-        tax_year -- the integer of the year for which to query
+        interactive -- whether to ask the user when a CUSIP lookup has no or multiple hits. Otherwise, a CUSIP with
+        no hits raises SecurityNotFound and the first of multiple hits is used.
+        '''
+        self.interactive = interactive
+
+    def get_dividend_exdates_in_windows(self, windows: Mapping[str, List[DateWindow]]) -> Union[Series, None]:
+        '''Gets the dividend history of each symbol within just its windows of dates.
 
-        Returns:
-        Returns the dividend history, as reported by yahoo finance.
+        Yahoo takes a single range of dates per request and fetches each symbol separately, so each symbol's windows
+        are coalesced into spans of its own (see COALESCE_GAP) rather than widened to those of other symbols.
+        Symbols with identical spans are requested together.
 
-        Example:
-        The series index is a tuple of Symbol, Date
+        The series index is a tuple of Symbol, Date, with the amount per share as the value:
         Symbol | Date
         VTI      2023-02-10  0.23
         VTI      2023-04-11  0.25
         VOO      2023-02-10  0.26
 
-        Caveat, this seems to generally return just a single date (as well as what appears to be the amount per share)
-        The date has, in the examples I've checked, been the ex dividend date. For the purposes of analysis, consumers of this
-        method should use some method to validate it's the correct date. I'm thinking comparing with the date on which dividends
-        were received should give a sense of whether its tracking record date or exdate.
-        """
-
-        # normalize lookup to a list
-        if isinstance(query, str):
-            query = [query]
-
-        query = cast(List[SecurityIdentifier], query)
-
-        # ensure that all the symbols are available
-        map(lambda x: x.hydrate(self), query)
-
-        securities_missing_symbols = [s for s in query if s.symbol is None]
-        if any(securities_missing_symbols):
-            logger.error(("All the tickers should have be populated but got "
-                          f"{','.join([s.cusip for s in securities_missing_symbols])} CUSIPS without symbols"))  # type: ignore
+        In the examples I've checked the date has been the ex dividend date, so consumers of this method validate it
+        against the dates on which dividends were received.
+        '''
+        symbols_by_span: Dict[DateWindow, List[str]] = {}
+        for symbol, symbol_windows in windows.items():
+            for span in coalesce_windows(symbol_windows, COALESCE_GAP):
+                symbols_by_span.setdefault(span, []).append(symbol)
+
+        histories: List[Series] = []
+        for span, symbols in symbols_by_span.items():
+            if logger.isEnabledFor(DEBUG):
+                logger.debug("Fetching dividend information for %s from %s to %s from Yahoo Query", ','.join(symbols),
+                             span.start.strftime('%Y-%m-%d'), span.end.strftime('%Y-%m-%d'))
+            dividend_history = self._get_dividend_history(symbols, span.start, span.end)
+            if dividend_history is None:
+                return None
+            histories.append(select_windows(dividend_history, {symbol: windows[symbol] for symbol in symbols}))
+
+        if len(histories) == 0:
+            return empty_exdates()
+        return concat(histories)
+
+    def _get_dividend_history(self, symbols: List[str], start: datetime, end: datetime) -> Union[Series, None]:
+        '''Gets the dividends paid by the symbols between the dates, or None if any of their histories couldn't be
+        fetched. yahooquery silently leaves out symbols it failed to fetch, so those are told apart from symbols
+        without dividends by their missing price history.'''
+        history = Ticker(symbols).history(start=start, end=end)
+        retrieved = set(history.index.get_level_values(0)) if isinstance(history, DataFrame) and len(history) > 0 else set()
+        failed = [symbol for symbol in symbols if symbol not in retrieved]
+        if len(failed) > 0:
+            logger.error("Failed to fetch the history of %s from Yahoo Query", ','.join(failed))
             return None
 
-        tickers: List[str] = [cast(str, security_id.symbol) for security_id in query]
-
-        logger.debug(f"Fetching dividend information for {','.join(tickers)} from Yahoo Query")
-
-        # have list of ticker symbols, fetch their dividend history
-        yahoo_tickers = Ticker(tickers)
-        dividend_history_frame = yahoo_tickers.dividend_history(
-            datetime(tax_year, 1, 1), datetime(tax_year + 1, 1, 1))
-        dividend_history = dividend_history_frame['dividends']
+        if 'dividends' not in history:
+            return empty_exdates()
+        return history.loc[history['dividends'].fillna(0) != 0, 'dividends']
 
-        return dividend_history
+    def get_ticker_candidates(self, cusip: str) -> List[str]:
+        logger.debug("Looking up %s with Yahoo Query", cusip)
+        search_results = search(cusip, quotes_count=1)
+        return [quote['symbol'] for quote in search_results['quotes']]
 
     def get_ticker_from_cusip(self, cusip: str) -> str:
-        logger.debug(f"Looking up {cusip} with Yahoo Query")
-        search_results = search(cusip, quotes_count=1)
-        quotes = search_results['quotes']
-        if len(quotes) < 1:
-            usr_input = input(f"Error: failed to lookup ticker for CUSIP: {cusip}. Enter it manually: ")
-            ticker = usr_input.rstrip("\n")
-        elif len(quotes) == 1:
-            ticker = quotes[0]['symbol']
-        else:
-            all_tickers = [q['symbol'] for q in quotes]
-            logger.warn(f"Got multiple hits for CUSIP {cusip}: {','.join(all_tickers)}.")
-            ticker_idx = user_selector.user_selection(f"Got multiple hits for CUSIP {cusip}. Which is the right symbol?", all_tickers)
-            ticker = all_tickers[ticker_idx]
-        return ticker
+        candidates = self.get_ticker_candidates(cusip)
+        if len(candidates) > 1:
+            logger.warning("Got multiple hits for CUSIP %s: %s.", cusip, ','.join(candidates))
+        if self.interactive:
+            return choose_ticker(cusip, candidates)
+        if len(candidates) == 0:
+            raise SecurityNotFound(f"No ticker found for CUSIP {cusip}")
+        return candidates[0]
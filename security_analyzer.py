@@ -4,6 +4,7 @@ import argparse
 import argcomplete
 from argcomplete.completers import FilesCompleter
 from datetime import datetime
+from logging import getLevelName
 
 from qualified_dividends_analyzer import analyze_qualified_dividends
 from summarizer import summarize
@@ -23,6 +24,14 @@ def main():
             " run which will automatically be applied where applicable"
         )).completer = csv_completer  # type: ignore
 
+    log_levels = ["DEBUG", "INFO", "WARNING", "ERROR"]
+    arg_parser.add_argument("--log-level", choices=log_levels, default="INFO",
+        help="The minimum level of log messages printed to the console. Defaults to INFO")
+    arg_parser.add_argument("--file-log-level", choices=log_levels, default="DEBUG",
+        help="The minimum level of log messages written to the log file. Defaults to DEBUG")
+    arg_parser.add_argument("--no-log-file", action="store_true",
+        help="Don't write a seclog_*.log file")
+
     subparsers = arg_parser.add_subparsers(required=True, help="subcommands")
 
     qualified_dividends_analyzer = subparsers.add_parser(
@@ -34,9 +43,34 @@ def main():
     qualified_dividends_analyzer.add_argument("-d", "--dividends", nargs="+", action='append', required=True, metavar="divs.csv",
         help="CSV files that contain the necessary information about dividends. May be specified multiple times."
     ).completer = csv_completer  # type: ignore
-    qualified_dividends_analyzer.add_argument("-y", "--year", nargs=1, action='store', required=False,
+    qualified_dividends_analyzer.add_argument("-y", "--year", type=int, action='store', required=False,
         default=datetime.now().year - 1,
-        help="The year for which to look up dividend information. Defaults to the previous year"
+        help="The tax year being analyzed. Qualified dividends paid in other years are passed through unchanged."
+            + " Defaults to the previous year"
+    )
+    qualified_dividends_analyzer.add_argument("-m", "--max-records", type=int, action='store', required=False, metavar="N",
+        help="Analyze out of core: sort lots and dividends through temporary files, holding at most N of them in memory"
+            + " at once. Useful when the closed lots don't fit in memory"
+    )
+    qualified_dividends_analyzer.add_argument("-j", "--jobs", type=int, action='store', required=False, default=1, metavar="N",
+        help="The number of processes across which to search for disqualifying lots when not running out of core."
+            + " Only that search is parallelized, and only once it's large enough to be worth starting the processes."
+            + " Defaults to 1"
+    )
+    qualified_dividends_analyzer.add_argument("--max-note-lots", type=int, action='store', required=False, metavar="N",
+        help="List at most N disqualifying lots in each note of the adjusted dividends csv. Defaults to listing all of them"
+    )
+    qualified_dividends_analyzer.add_argument("--audit-file", action='store', required=False, metavar="audit.csv",
+        help="Also write a csv with a row for every lot that disqualified a dividend"
+    )
+    qualified_dividends_analyzer.add_argument("--cache", action='store', required=False, default="security_cache",
+        metavar="FILE", help="Where to persist looked up symbols and exdates between runs. Defaults to security_cache"
+    )
+    qualified_dividends_analyzer.add_argument("--no-cache", action='store_true',
+        help="Don't read or persist looked up symbols and exdates between runs"
+    )
+    qualified_dividends_analyzer.add_argument("--hedge-after", type=float, action='store', required=False,
+        metavar="SECONDS", help="Send a second, hedged request for any lookup that takes longer than this"
     )
     qualified_dividends_analyzer.set_defaults(func=analyze_qualified_dividends)
 
@@ -59,7 +93,7 @@ def main():
     args = arg_parser.parse_args()
 
     # order matter -- only configure the logger if we're about to delegate to a subcommand
-    configure_logger()
+    configure_logger(getLevelName(args.log_level), getLevelName(args.file_log_level), not args.no_log_file)
 
     if args.selections:
         user_selector.import_selections(args.selections)
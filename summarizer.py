@@ -1,14 +1,14 @@
 from functools import reduce
 from itertools import chain
 import numpy as np
-from typing import List
+from typing import Dict, Iterable, List
 
 from logging import getLogger
 from argparse import Namespace
 
-# from models.closed_lot import ClosedLot
+from models.closed_lot import LONG_TERM_HOLDING_PERIOD
 from models.dividend import Dividend, DividendType
-# from parsers.closed_lot_parser import read_closed_lots
+from parsers.closed_lot_parser import read_closed_lot_columns
 from parsers.dividend_parser import read_dividends
 
 logger = getLogger(__name__)
@@ -39,26 +39,59 @@ def print_dividend_summary(dividend_summary: np.ndarray):
 """)
 
 
+def lot_summary(lot_chunks: Iterable[Dict[str, np.ndarray]]) -> np.ndarray:
+    '''Totals proceeds, cost basis and gain for short and long term lots, one columnar chunk at a time.
+    Rows of the summary are short term then long term, columns are proceeds, cost basis and gain.'''
+    summary = np.zeros((2, 3))
+    for chunk in lot_chunks:
+        # the same classification as ClosedLot.holding_period / ClosedLot.is_long_term
+        holding_period = (chunk["close_date"] - chunk["open_date"]).astype(int)
+        long_term = holding_period > LONG_TERM_HOLDING_PERIOD
+
+        values = np.column_stack([chunk["proceeds"], chunk["cost_basis"], chunk["proceeds"] - chunk["cost_basis"]])
+        summary[0] += values[~long_term].sum(axis=0)
+        summary[1] += values[long_term].sum(axis=0)
+
+    print_lot_summary(summary)
+    return summary
+
+
+def print_lot_summary(lot_summary: np.ndarray):
+    total = lot_summary.sum(axis=0)
+    print(f""">>> Proceeds from Broker Transactions
+>>>                                   Proceeds      Cost basis       Gain/loss
+>>> Short-term                  {lot_summary[0][0]:>14.2f}  {lot_summary[0][1]:>14.2f}  {lot_summary[0][2]:>14.2f}
+>>> Long-term                   {lot_summary[1][0]:>14.2f}  {lot_summary[1][1]:>14.2f}  {lot_summary[1][2]:>14.2f}
+>>> Total                       {total[0]:>14.2f}  {total[1]:>14.2f}  {total[2]:>14.2f}
+""")
+
+
 def summarize(args: Namespace):
     logger.info("Running summerizer")
 
     # read all input CSVs
-    # flattened_lots_files = chain.from_iterable(args.lots)
-    flattened_dividends_files = chain.from_iterable(args.dividends)
+    flattened_lots_files = list(chain.from_iterable(args.lots or []))
+    flattened_dividends_files = list(chain.from_iterable(args.dividends or []))
 
     # handle each file separately for granularity of data
     dividends_summaries = []
     for dividend_file in flattened_dividends_files:
         dividends = read_dividends(dividend_file)
+        print(f">>> {dividend_file}")
 
         dividends_summaries.append(dividend_summary(dividends))
 
-    if len(list(flattened_dividends_files)) > 1:
+    if args.aggregate and len(dividends_summaries) > 1:
         full_dividends = reduce(lambda acc, next: acc + next, dividends_summaries, np.zeros_like(dividends_summaries[0]))
         print(">>> Aggregated Total")
         print_dividend_summary(full_dividends)
 
-    # TODO: lots
-    # closed_lots_summaries = []
-    # for closed_lot_file in flattened_lots_files:
-    #     closed_lots_summaries.append(lot_summary(read_closed_lots(closed_lot_file)))
+    closed_lots_summaries = []
+    for closed_lot_file in flattened_lots_files:
+        print(f">>> {closed_lot_file}")
+        closed_lots_summaries.append(lot_summary(read_closed_lot_columns(closed_lot_file)))
+
+    if args.aggregate and len(closed_lots_summaries) > 1:
+        full_lots = reduce(lambda acc, next: acc + next, closed_lots_summaries, np.zeros_like(closed_lots_summaries[0]))
+        print(">>> Aggregated Total")
+        print_lot_summary(full_lots)
@@ -0,0 +1,5 @@
+import sys
+from pathlib import Path
+
+# the modules are imported from the repository root, as security_analyzer does
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
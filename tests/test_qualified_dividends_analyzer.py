@@ -0,0 +1,138 @@
+import copy
+import random
+from datetime import datetime, timedelta
+from typing import Dict, List, Mapping, Union
+
+import pytest
+from pandas import MultiIndex
+from pandas.core.series import Series
+
+import qualified_dividends_analyzer
+from models.dividend import Dividend
+from parsers.closed_lot_parser import read_closed_lot_records
+from parsers.dividend_parser import read_dividend_records
+from qualified_dividends_analyzer import analyze_dividends, analyze_dividends_out_of_core
+from repositories.security_repository import SecurityNotFound, SecurityRepository
+from utilities.exdate_windows import DateWindow, empty_exdates, select_windows
+
+
+class StubRepository(SecurityRepository):
+    '''Serves symbols and exdates from dictionaries, recording the exdate windows it's asked for'''
+    def __init__(self, symbols: Dict[str, str], exdates: Dict[str, Dict[datetime, float]]):
+        self.symbols = symbols
+        self.exdates = exdates
+        self.requested_windows: List[Mapping[str, List[DateWindow]]] = []
+
+    def get_ticker_from_cusip(self, cusip: str) -> str:
+        if cusip not in self.symbols:
+            raise SecurityNotFound(f"No ticker found for CUSIP {cusip}")
+        return self.symbols[cusip]
+
+    def get_dividend_exdates_in_windows(self, windows: Mapping[str, List[DateWindow]]) -> Union[Series, None]:
+        self.requested_windows.append(windows)
+        index = [(symbol, exdate.date()) for symbol in windows for exdate in self.exdates.get(symbol, {})]
+        if len(index) == 0:
+            return empty_exdates()
+        values = [value for symbol in windows for value in self.exdates.get(symbol, {}).values()]
+        exdates = Series(values, index=MultiIndex.from_tuples(index, names=["symbol", "date"]), name="dividends")
+        return select_windows(exdates, windows)
+
+
+def random_portfolio(seed: int):
+    '''A year of monthly dividends and a few thousand lots across a handful of securities, plus the dividends of a
+    CUSIP which can't be resolved'''
+    rng = random.Random(seed)
+    symbols = {f"C{idx}": symbol for idx, symbol in enumerate(["AAA", "BBB", "CCC", "DDD"])}
+    exdates = {symbol: {datetime(2023, month, 10): round(rng.uniform(0.1, 2), 2) for month in range(1, 13)}
+               for symbol in symbols.values()}
+
+    lots = []
+    for _ in range(2000):
+        cusip = rng.choice(list(symbols))
+        open_date = datetime(2022, 11, 1) + timedelta(days=rng.randint(0, 400))
+        close_date = open_date + timedelta(days=rng.randint(0, 120))
+        lots.append({"symbol": symbols[cusip], "cusip": cusip, "quantity": str(rng.randint(1, 9)),
+                     "Open Date": open_date.strftime("%Y-%m-%d"), "Close Date": close_date.strftime("%Y-%m-%d")})
+
+    dividends = []
+    for cusip in list(symbols) + ["UNKNOWN"]:
+        for month in range(1, 13):
+            dividends.append({"Payout Date": f"2023-{month:02d}-20", "CUSIP": cusip, "Amount": str(100 + month),
+                              "Type": rng.choice(["Qualified", "Section 199A"])})
+            dividends.append({"Payout Date": f"2023-{month:02d}-20", "CUSIP": cusip, "Amount": "7",
+                              "Type": "Non-Qualified"})
+    return symbols, exdates, lots, dividends
+
+
+def dividend_key(div: Dividend):
+    return (div.security_id.symbol or "", div.security_id.cusip, div.date, div.type.value, div.value,
+            div.csv_row().get("notes"))
+
+
+def disqualification_key(dq):
+    return (dq.security_id.symbol, dq.payout_date, dq.exdate, dq.dividend_type.value, dq.disqualified_value,
+            tuple(lot.lot_id for lot in dq.lots))
+
+
+def analyze_out_of_core(symbols, exdates, lots, dividends, tax_year: int, max_records: int):
+    disqualifications: List = []
+    adjusted = list(analyze_dividends_out_of_core(
+        read_closed_lot_records(copy.deepcopy(lots)), read_dividend_records(copy.deepcopy(dividends)),
+        StubRepository(symbols, exdates), tax_year, max_records, disqualifications.append))
+    return adjusted, disqualifications
+
+
+@pytest.mark.parametrize("seed", [1, 2])
+def test_out_of_core_matches_in_memory(seed: int):
+    symbols, exdates, lots, dividends = random_portfolio(seed)
+
+    expected = analyze_dividends(copy.deepcopy(lots), copy.deepcopy(dividends), StubRepository(symbols, exdates), 2023)
+    adjusted, disqualifications = analyze_out_of_core(symbols, exdates, lots, dividends, 2023, max_records=7)
+
+    assert len(expected.disqualifications) > 0
+    assert sorted(map(dividend_key, adjusted)) == sorted(map(dividend_key, expected.dividends))
+    assert sorted(map(disqualification_key, disqualifications)) == \
+        sorted(map(disqualification_key, expected.disqualifications))
+    # the dividends of the unresolved CUSIP pass through unchanged
+    assert len([div for div in adjusted if div.security_id.cusip == "UNKNOWN"]) == 24
+
+
+def test_analysis_variants_match(monkeypatch):
+    symbols, exdates, lots, dividends = random_portfolio(3)
+
+    def analyze(**kwargs):
+        result = analyze_dividends(copy.deepcopy(lots), copy.deepcopy(dividends), StubRepository(symbols, exdates),
+                                   2023, **kwargs)
+        return [dividend_key(div) for div in result.dividends], \
+            [disqualification_key(dq) for dq in result.disqualifications]
+
+    expected = analyze()
+    assert analyze(prefetch=False) == expected
+    # start the process pool however small the search is
+    monkeypatch.setattr(qualified_dividends_analyzer, "MIN_PARALLEL_COST", 0)
+    assert analyze(jobs=3) == expected
+
+
+def test_january_payout_with_december_exdate():
+    '''The exdate of a dividend paid early in the tax year can fall in the year before, and must still be fetched'''
+    symbols = {"J1": "JAN"}
+    exdates = {"JAN": {datetime(2022, 12, 28): 1.0, datetime(2023, 6, 10): 1.0}}
+    lots = [{"symbol": "JAN", "cusip": "J1", "quantity": "10", "Open Date": "2022-12-20", "Close Date": "2023-01-05"}]
+    dividends = [{"Payout Date": "2023-01-15", "CUSIP": "J1", "Amount": "10", "Type": "Qualified"},
+                 {"Payout Date": "2023-06-20", "CUSIP": "J1", "Amount": "10", "Type": "Qualified"}]
+
+    for prefetch in (False, True):
+        repository = StubRepository(symbols, exdates)
+        result = analyze_dividends(copy.deepcopy(lots), copy.deepcopy(dividends), repository, 2023, prefetch=prefetch)
+        assert [(dq.payout_date, dq.exdate) for dq in result.disqualifications] == \
+            [(datetime(2023, 1, 15), datetime(2022, 12, 28))]
+        assert [window.start.year for windows in repository.requested_windows
+                for symbol_windows in windows.values() for window in symbol_windows] == [2022]
+
+    adjusted, disqualifications = analyze_out_of_core(symbols, exdates, lots, dividends, 2023, max_records=1)
+    assert [(dq.payout_date, dq.exdate) for dq in disqualifications] == [(datetime(2023, 1, 15), datetime(2022, 12, 28))]
+    assert sorted((div.date, div.type.value, div.value) for div in adjusted) == [
+        (datetime(2023, 1, 15), "Non-Qualified", 10.0),
+        (datetime(2023, 1, 15), "Qualified", 0.0),
+        (datetime(2023, 6, 20), "Qualified", 10.0),
+    ]
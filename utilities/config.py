@@ -1,17 +1,48 @@
 import sys
+from atexit import register
 from datetime import datetime
-from logging import getLogger, StreamHandler, Formatter, FileHandler, INFO, DEBUG
+from logging import getLogger, StreamHandler, Formatter, FileHandler, Handler, LogRecord, INFO, DEBUG
+from logging.handlers import QueueHandler, QueueListener
+from queue import SimpleQueue
+from typing import List
 
 
-def configure_logger():
+class DeferredQueueHandler(QueueHandler):
+    '''Enqueues records as they are, leaving their messages to be formatted by the listener's handlers.
+
+    QueueHandler.prepare formats each record on the logging thread, so that the record can be pickled. The queue
+    here never leaves the process, so that isn't needed, but the arguments of a record must then not be changed
+    after it's logged.
+    '''
+    def prepare(self, record: LogRecord) -> LogRecord:
+        return record
+
+
+def configure_logger(console_level: int = INFO, file_level: int = DEBUG, log_to_file: bool = True) -> QueueListener:
+    '''Routes all logging through a queue so that formatting and writing records happen on a background thread.
+
+    The root logger level is the most verbose of the enabled handlers, so log calls below every handler's level
+    are discarded up front by the calling thread. The returned listener is stopped (and the queue flushed) at exit.
+    '''
     root_logger = getLogger()
-    print_handler = StreamHandler(sys.stdout)
-    file_handler = FileHandler(f"seclog_{datetime.now().strftime('%Y-%m-%d_%H:%M')}.log")
     formatter = Formatter('[%(asctime)s] [%(name)s] [%(levelname)s] %(message)s')
+
+    print_handler = StreamHandler(sys.stdout)
     print_handler.setFormatter(formatter)
-    print_handler.setLevel(INFO)
-    file_handler.setFormatter(formatter)
-    file_handler.setLevel(DEBUG)
-    root_logger.addHandler(print_handler)
-    root_logger.addHandler(file_handler)
-    root_logger.setLevel(DEBUG)
+    print_handler.setLevel(console_level)
+    handlers: List[Handler] = [print_handler]
+
+    if log_to_file:
+        file_handler = FileHandler(f"seclog_{datetime.now().strftime('%Y-%m-%d_%H:%M')}.log")
+        file_handler.setFormatter(formatter)
+        file_handler.setLevel(file_level)
+        handlers.append(file_handler)
+
+    log_queue: SimpleQueue = SimpleQueue()
+    listener = QueueListener(log_queue, *handlers, respect_handler_level=True)
+    root_logger.addHandler(DeferredQueueHandler(log_queue))
+    root_logger.setLevel(min(handler.level for handler in handlers))
+
+    listener.start()
+    register(listener.stop)
+    return listener
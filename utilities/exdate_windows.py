@@ -0,0 +1,160 @@
+from bisect import bisect_left, bisect_right
+from datetime import datetime, timedelta
+from typing import Dict, List, Mapping, NamedTuple, Optional, Set
+from pandas import MultiIndex
+from pandas.core.series import Series
+import numpy as np
+
+# the longest an exdate is assumed to precede its payout date
+MAX_EXDATE_LAG = timedelta(days=90)
+
+# windows closer together than this are fetched as one, trading a few extra days of history for a round trip
+COALESCE_GAP = timedelta(days=7)
+
+
+class DateWindow(NamedTuple):
+    '''A range of dates, including start and excluding end'''
+    start: datetime
+    end: datetime
+
+    def overlaps(self, other: "DateWindow") -> bool:
+        return self.start < other.end and other.start < self.end
+
+
+def exdate_window(payout_date: datetime) -> DateWindow:
+    '''The dates on which the exdate of a dividend paid on payout_date could fall'''
+    return DateWindow(payout_date - MAX_EXDATE_LAG, payout_date)
+
+
+def tax_year_window(tax_year: int) -> DateWindow:
+    '''The dates on which dividends reported for the tax year were paid'''
+    return DateWindow(datetime(tax_year, 1, 1), datetime(tax_year + 1, 1, 1))
+
+
+def holding_window(open_date: datetime, close_date: datetime) -> DateWindow:
+    '''The exdates for which a lot open between the dates would have received the dividend.
+    Buying on the exdate doesn't get the dividend, but selling on it does.'''
+    return DateWindow(open_date + timedelta(days=1), close_date + timedelta(days=1))
+
+
+def coalesce_windows(windows: List[DateWindow], gap: timedelta = timedelta(0)) -> List[DateWindow]:
+    '''Merges windows which overlap or are separated by no more than gap, returning them in order'''
+    coalesced: List[DateWindow] = []
+    for window in sorted(windows):
+        if len(coalesced) > 0 and window.start <= coalesced[-1].end + gap:
+            if window.end > coalesced[-1].end:
+                coalesced[-1] = DateWindow(coalesced[-1].start, window.end)
+        else:
+            coalesced.append(window)
+    return coalesced
+
+
+def covers(windows: List[DateWindow], window: DateWindow) -> bool:
+    '''Whether the window lies entirely within one of the coalesced windows'''
+    idx = bisect_right(windows, window) - 1
+    return any(0 <= i < len(windows) and windows[i].start <= window.start and window.end <= windows[i].end
+               for i in (idx, idx + 1))
+
+
+class WindowSet:
+    '''A growing union of date windows, kept coalesced'''
+    def __init__(self):
+        self.windows: List[DateWindow] = []
+
+    def intersects(self, window: DateWindow) -> bool:
+        idx = bisect_left(self.windows, window)
+        return any(0 <= i < len(self.windows) and self.windows[i].overlaps(window) for i in (idx - 1, idx))
+
+    def add(self, window: DateWindow) -> List[DateWindow]:
+        '''Adds the window to the set, returning the parts of it which weren't already in it'''
+        gaps: List[DateWindow] = []
+        start = window.start
+        # windows are disjoint, so only the one before the window's position can reach into it
+        for existing in self.windows[max(bisect_left(self.windows, window) - 1, 0):]:
+            if existing.end <= start:
+                continue
+            if existing.start >= window.end:
+                break
+            if existing.start > start:
+                gaps.append(DateWindow(start, existing.start))
+            start = max(start, existing.end)
+        if start < window.end:
+            gaps.append(DateWindow(start, window.end))
+
+        if len(gaps) > 0:
+            self.windows = coalesce_windows(self.windows + [window])
+        return gaps
+
+
+class ExdatePlanner:
+    '''Works out which dates need exdates, so they can be fetched for just those windows.
+
+    A dividend can only be disqualified by a short lot which was open across its exdate, which falls in the
+    window before its payout date (see exdate_window). Payout windows are planned once they intersect the holding
+    window of a short lot of the same security. Payout dates and short lots can be added in either order, and the
+    short lots are held only as a coalesced set of windows, so the planner stays small however many lots there are.
+    Only payouts within payout_window, if given, are planned; their exdates may still fall before it.
+    '''
+    def __init__(self, payout_window: Optional[DateWindow] = None):
+        self._payout_window = payout_window
+        self._payouts: Dict[str, List[datetime]] = {}
+        self._planned: Dict[str, Set[datetime]] = {}
+        self._holdings: Dict[str, WindowSet] = {}
+
+    def add_payout(self, symbol: str, payout_date: datetime) -> List[DateWindow]:
+        '''Adds the payout date of a qualified dividend, returning its exdate window if that became planned'''
+        if not self.plans(payout_date):
+            return []
+        payouts = self._payouts.setdefault(symbol, [])
+        idx = bisect_left(payouts, payout_date)
+        if idx < len(payouts) and payouts[idx] == payout_date:
+            return []
+        payouts.insert(idx, payout_date)
+
+        holdings = self._holdings.get(symbol)
+        window = exdate_window(payout_date)
+        if holdings is None or not holdings.intersects(window):
+            return []
+        self._planned.setdefault(symbol, set()).add(payout_date)
+        return [window]
+
+    def plans(self, payout_date: datetime) -> bool:
+        '''Whether the payout date is within the payout window, and so can be planned'''
+        window = self._payout_window
+        return window is None or window.start <= payout_date < window.end
+
+    def add_short_lot(self, symbol: str, open_date: datetime, close_date: datetime) -> List[DateWindow]:
+        '''Adds a short lot, returning the exdate windows which became planned because of it'''
+        holding = holding_window(open_date, close_date)
+        if len(self._holdings.setdefault(symbol, WindowSet()).add(holding)) == 0:
+            return []
+
+        # only payouts within MAX_EXDATE_LAG after the holding have windows which can intersect it
+        payouts = self._payouts.get(symbol, [])
+        planned = self._planned.setdefault(symbol, set())
+        windows: List[DateWindow] = []
+        for payout_date in payouts[bisect_right(payouts, holding.start):bisect_left(payouts, holding.end + MAX_EXDATE_LAG)]:
+            window = exdate_window(payout_date)
+            if payout_date not in planned and window.overlaps(holding):
+                planned.add(payout_date)
+                windows.append(window)
+        return windows
+
+    def windows(self, gap: timedelta = COALESCE_GAP) -> Dict[str, List[DateWindow]]:
+        '''The coalesced exdate windows of each symbol with any planned payouts'''
+        return {symbol: coalesce_windows([exdate_window(payout_date) for payout_date in planned], gap)
+                for symbol, planned in sorted(self._planned.items()) if len(planned) > 0}
+
+
+def empty_exdates() -> Series:
+    '''An exdate history without any exdates, indexed like a populated one'''
+    return Series([], index=MultiIndex.from_arrays([[], []], names=["symbol", "date"]), dtype=float, name="dividends")
+
+
+def select_windows(exdates: Series, windows: Mapping[str, List[DateWindow]]) -> Series:
+    '''Selects the exdates which fall within their symbol's windows'''
+    def selected(symbol: str, exdate) -> bool:
+        exdate = datetime(exdate.year, exdate.month, exdate.day)
+        return any(window.start <= exdate < window.end for window in windows.get(symbol, []))
+
+    return exdates[np.array([selected(symbol, exdate) for symbol, exdate in exdates.index], dtype=bool)]
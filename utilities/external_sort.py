@@ -0,0 +1,66 @@
+import pickle
+from heapq import merge
+from tempfile import TemporaryFile
+from typing import IO, Any, Callable, Iterable, Iterator, List, TypeVar
+
+T = TypeVar("T")
+
+
+def open_run() -> IO[bytes]:
+    '''Opens an empty run in an anonymous temporary file, which is deleted once closed'''
+    return TemporaryFile()
+
+
+def append_to_run(run: IO[bytes], item: T):
+    '''Spills a single item to the end of a run'''
+    pickle.dump(item, run, pickle.HIGHEST_PROTOCOL)
+
+
+def write_run(items: Iterable[T]) -> IO[bytes]:
+    '''Spills items to an anonymous temporary file, which is deleted once closed'''
+    run = open_run()
+    for item in items:
+        append_to_run(run, item)
+    run.seek(0)
+    return run
+
+
+def read_run(run: IO[bytes]) -> Iterator[T]:
+    '''Streams the items of a run back in the order they were written'''
+    run.seek(0)
+    while True:
+        try:
+            yield pickle.load(run)
+        except EOFError:
+            return
+
+
+def external_sort(items: Iterable[T], key: Callable[[T], Any], max_items_in_memory: int) -> Iterator[T]:
+    '''Stably sorts items while holding at most max_items_in_memory of them in memory at once.
+
+    Items are buffered, sorted and spilled to temporary files (runs) as the buffer fills, and the runs are then
+    lazily merged. If everything fits in a single buffer, nothing touches the disk.
+    '''
+    assert max_items_in_memory > 0, "At least one item must be held in memory to sort"
+    runs: List[IO[bytes]] = []
+    buffer: List[T] = []
+    try:
+        for item in items:
+            buffer.append(item)
+            if len(buffer) >= max_items_in_memory:
+                buffer.sort(key=key)
+                runs.append(write_run(buffer))
+                buffer = []
+
+        buffer.sort(key=key)
+        if len(runs) == 0:
+            yield from buffer
+            return
+
+        runs.append(write_run(buffer))
+        buffer = []
+        # ties resolve to the earlier run, which keeps the merge stable
+        yield from merge(*[read_run(run) for run in runs], key=key)
+    finally:
+        for run in runs:
+            run.close()
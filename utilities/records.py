@@ -0,0 +1,19 @@
+from typing import Iterable, Iterator
+
+
+def iter_records(source: Iterable) -> Iterator:
+    '''Normalizes tabular in-memory data into an iterator of rows.
+
+    The rows of a pandas DataFrame or a numpy record (structured) array are produced as dictionaries.
+    Any other iterable (e.g. of mappings or model instances) is passed through row by row.
+    '''
+    if hasattr(source, "to_dict") and hasattr(source, "columns"):
+        # pandas DataFrame
+        yield from source.to_dict("records")  # type: ignore
+    elif getattr(getattr(source, "dtype", None), "names", None):
+        # numpy record / structured array
+        names = source.dtype.names  # type: ignore
+        for row in source.tolist():  # type: ignore
+            yield dict(zip(names, row))
+    else:
+        yield from source
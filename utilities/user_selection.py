@@ -3,11 +3,15 @@ from typing import List, Optional, Dict, Union
 from datetime import datetime
 
 import csv
+from threading import RLock
 
 from logging import getLogger
 
 logger = getLogger(__name__)
 
+# held while interacting with the user, so that prompts from concurrent lookups don't interleave
+prompt_lock = RLock()
+
 
 def try_parse_int(input: str) -> bool:
     try:
@@ -27,17 +31,19 @@ class UserSelection:
 
         lookup_result = self.lookup_selection(prompt, serialized_selections)
         if lookup_result:
-            logger.debug(f"Using previously supplied answer '{lookup_result}' to prompt '{prompt}'")
+            logger.debug("Using previously supplied answer '%s' to prompt '%s'", lookup_result, prompt)
             return sequence.index(lookup_result)
 
         self.made_new_selection = True
 
-        print(prompt)
-        for idx, s in enumerate(sequence):
-            print(f" [{idx}]: {s}")
-        selection = input("")
-        while not try_parse_int(selection):
-            selection = input("Invalid, try again: ")
+        # prompts may come from background lookups, so only one may be shown at a time
+        with prompt_lock:
+            print(prompt)
+            for idx, s in enumerate(sequence):
+                print(f" [{idx}]: {s}")
+            selection = input("")
+            while not try_parse_int(selection):
+                selection = input("Invalid, try again: ")
         selected_index = int(selection)
 
         self.selections.append(
@@ -74,21 +80,33 @@ class UserSelection:
                 writer = csv.DictWriter(f, self.selections[0].keys())
                 writer.writeheader()
                 writer.writerows(self.selections)
-            logger.info(f"Wrote user selections to {filename}. They can be reused with the '-s' flag")
+            logger.info("Wrote user selections to %s. They can be reused with the '-s' flag", filename)
         else:
             logger.debug("There were no user selections to record.")
 
     def import_selections(self, filename: str):
-        logger.info(f"Importing selections file {filename}")
+        logger.info("Importing selections file %s", filename)
         with open(filename, "r") as f:
             reader = csv.DictReader(f)
             for row in reader:
                 if "prompt" in row and "sequence" in row and "selection" in row:
                     self.selections.append(row)
                 else:
-                    logger.warn(
-                        f"Imported selection missing one or more of the expected members and will not be imported: {row}"
+                    logger.warning(
+                        "Imported selection missing one or more of the expected members and will not be imported: %s", row
                     )
 
 
 user_selector = UserSelection()
+
+
+def choose_ticker(cusip: str, candidates: List[str]) -> str:
+    '''Asks the user which of the candidate symbols the CUSIP refers to, or to enter it if there aren't any'''
+    if len(candidates) == 1:
+        return candidates[0]
+    if len(candidates) > 1:
+        ticker_idx = user_selector.user_selection(f"Got multiple hits for CUSIP {cusip}. Which is the right symbol?", candidates)
+        return candidates[ticker_idx]
+    with prompt_lock:
+        usr_input = input(f"Error: failed to lookup ticker for CUSIP: {cusip}. Enter it manually: ")
+    return usr_input.rstrip("\n")